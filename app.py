@@ -3,587 +3,2638 @@
 # VISHAL X BOT - ENTERPRISE PROTECTION v2.2
 # Critical Fixes Applied
 # ============================================================
-import os, time, requests, threading, sqlite3, json
+import os, time, requests, threading, sqlite3, json, socket, uuid, math
 from datetime import datetime, timedelta
-from flask import Flask, jsonify, request, Response
+from flask import Flask, jsonify, request, Response, g, send_file
+from werkzeug.exceptions import RequestEntityTooLarge
 import queue
+import heapq, itertools, hmac, bisect, sys
+import cProfile, pstats, io, csv, zlib, gzip, hashlib, functools
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError, ConnectTimeoutError
 
 # ===================== CONFIG ===============================
 BOT_TOKEN = os.getenv("BOT_TOKEN", "8504965473:AAE0yYTi4DWvpdopOBkjA0AucJf0tknHDJE")
 CHANNEL = os.getenv("CHANNEL", "@vishalxnetwork4")
 ADMIN_KEY = os.getenv("ADMIN_KEY", "VISHAL2026")
-API = f"https://api.telegram.org/bot{BOT_TOKEN}"
+API_BASE = os.getenv("API_BASE", "https://api.telegram.org")
+API = f"{API_BASE}/bot{BOT_TOKEN}"
+FILE_API = f"{API_BASE}/file/bot{BOT_TOKEN}"
 PORT = int(os.getenv("PORT", 8080))
-SCAN_TIME = 30
+DB_PATH = os.getenv("DB_PATH", "database/data.db")
+SCAN_TIME = 30  # shortest re-check interval (strikes, recent joins)
+MEMBER_EVENTS = os.getenv("MEMBER_EVENTS", "1") == "1"  # bot is channel admin
+SCAN_MAX_INTERVAL = int(os.getenv("SCAN_MAX_INTERVAL", 1800 if MEMBER_EVENTS else 300))  # stable members
+SCAN_BACKOFF = float(os.getenv("SCAN_BACKOFF", 2.0))  # interval growth per stable check
+SCHEDULE_RELOAD = 300  # seconds between schedule/expiry reloads from user_states
+SCHEDULE_NUDGE_POLL = float(os.getenv("SCHEDULE_NUDGE_POLL", 2))  # seconds between schedule_nudges polls
+EXPIRY_BATCH_SIZE = int(os.getenv("EXPIRY_BATCH_SIZE", 100))  # expired users per delete batch
+LEASE_TTL = int(os.getenv("LEASE_TTL", 30))  # seconds a leader lease stays valid
+LEASE_HEARTBEAT = int(os.getenv("LEASE_HEARTBEAT", 10))  # seconds between lease renewals
+MONITOR_SHARDS = int(os.getenv("MONITOR_SHARDS", 8))  # sweep partitions (tg % MONITOR_SHARDS), leased per process
+MEMBER_CACHE_TTL = int(os.getenv("MEMBER_CACHE_TTL", 60))  # seconds, member results
+MEMBER_CACHE_NEGATIVE_TTL = int(os.getenv("MEMBER_CACHE_NEGATIVE_TTL", 10))  # left results
+MEMBER_CACHE_SIZE = int(os.getenv("MEMBER_CACHE_SIZE", 100000))
+KNOWN_USERS_SIZE = int(os.getenv("KNOWN_USERS_SIZE", 500000))  # user ids remembered as having user_states
+KNOWN_USERS_TTL = int(os.getenv("KNOWN_USERS_TTL", 600))  # re-verify after this long (other processes may delete)
+ID_COUNT_CACHE_SIZE = int(os.getenv("ID_COUNT_CACHE_SIZE", 100000))  # per-user active-ID counts kept in memory
+ID_COUNT_TTL = int(os.getenv("ID_COUNT_TTL", 60))  # re-read after this long (other processes may write)
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", 5000))  # IDs per bulk-import transaction
+IMPORT_MAX_IDS = int(os.getenv("IMPORT_MAX_IDS", 200000))  # unique IDs accepted per import
+IMPORT_MAX_ID_LENGTH = int(os.getenv("IMPORT_MAX_ID_LENGTH", 128))
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", 20 * 1024 * 1024))  # Bot API getFile limit
+IMPORT_MAX_LINES = int(os.getenv("IMPORT_MAX_LINES", 1000000))  # lines read per import, valid or not
 MAX_STRIKES = 3
 SUSPEND_DURATION = 3600
 DOUBLE_CHECK_DELETE = True
+SWEEP_WORKERS = int(os.getenv("SWEEP_WORKERS", 16))
+SWEEP_BATCH_SIZE = int(os.getenv("SWEEP_BATCH_SIZE", 500))  # users per sweep commit
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", 5000))  # rows per fetchmany()
+EXPORT_COMPRESS_LEVEL = int(os.getenv("EXPORT_COMPRESS_LEVEL", 6))  # gzip/deflate level for /export
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", os.path.join(os.path.dirname(DB_PATH) or ".", "snapshots"))
+SNAPSHOT_POLL = float(os.getenv("SNAPSHOT_POLL", 1))  # seconds between ids_version checks
+SNAPSHOT_DEBOUNCE = float(os.getenv("SNAPSHOT_DEBOUNCE", 2))  # rebuild once writes are quiet this long
+SNAPSHOT_MAX_DELAY = float(os.getenv("SNAPSHOT_MAX_DELAY", 15))  # ...or a change has waited this long
+SNAPSHOT_KEEP = int(os.getenv("SNAPSHOT_KEEP", 600))  # seconds superseded snapshot files are kept
+CHANGES_RETENTION = int(os.getenv("CHANGES_RETENTION", 7 * 86400))  # seconds of id_changes kept for /changes
+CHANGES_MAX_ROWS = int(os.getenv("CHANGES_MAX_ROWS", 1000000))  # ...and at most this many entries
+CHANGES_COMPACT_INTERVAL = int(os.getenv("CHANGES_COMPACT_INTERVAL", 3600))
+CHANGES_PAGE_SIZE = int(os.getenv("CHANGES_PAGE_SIZE", 1000))  # default /changes limit (max 10x)
+API_RATE_LIMIT = float(os.getenv("API_RATE_LIMIT", 25))  # Bot API calls per second
+API_BURST = int(os.getenv("API_BURST", 30))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 32))
+SEND_RATE_LIMIT = float(os.getenv("SEND_RATE_LIMIT", 25))  # outbound messages per second
+SEND_CHAT_INTERVAL = float(os.getenv("SEND_CHAT_INTERVAL", 1.0))  # seconds between messages to one chat
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", 4))
+SEND_QUEUE_SIZE = int(os.getenv("SEND_QUEUE_SIZE", 10000))
+SEND_MAX_ATTEMPTS = 5
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 8))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 1000))  # per worker
+UPDATE_MODE = os.getenv("UPDATE_MODE", "polling")  # "polling" or "webhook"
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # public https URL routed to /webhook
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
 
-# ===================== DATABASE =============================
-os.makedirs("database", exist_ok=True)
+# Outbound priority classes (lower is sent first)
+PRIORITY_CALLBACK = 0
+PRIORITY_REPLY = 1
+PRIORITY_WARNING = 2
+PRIORITY_BROADCAST = 3
+MEMBER_STATUSES = ("member", "administrator", "creator")
+ALLOWED_UPDATES = ["message", "callback_query", "chat_member"]
 
-# Thread-safe database connection pool
-class Database:
-    def __init__(self):
-        self.connections = {}
+# Per-method (timeout seconds, retries) - retries only where repeating is harmless
+API_METHOD_POLICY = {
+    "getUpdates": (40, 0),
+    "getChatMember": (10, 2),
+    "sendMessage": (10, 0),
+    "answerCallbackQuery": (5, 1),
+    "deleteWebhook": (10, 2),
+    "setWebhook": (10, 2),
+    "getFile": (10, 2),
+}
+DEFAULT_API_POLICY = (10, 1)
+# A lost response may still mean the call happened; these are only retried
+# when the request provably never reached Telegram
+NON_IDEMPOTENT_METHODS = {"sendMessage"}
+
+# SQLite storage profile (applied to every connection)
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", 16384))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", 256 * 1024 * 1024))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", 5000))
+DB_POOL_READERS = int(os.getenv("DB_POOL_READERS", 8))  # max reader connections (plus one writer)
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))  # seconds to wait for a connection
+DB_POOL_IDLE_TIMEOUT = float(os.getenv("DB_POOL_IDLE_TIMEOUT", 60))  # close readers idle this long
+
+# Slow-operation log thresholds (milliseconds, adjustable at runtime via /admin/slow)
+SLOW_HANDLER_MS = float(os.getenv("SLOW_HANDLER_MS", 500))
+SLOW_SQL_MS = float(os.getenv("SLOW_SQL_MS", 100))
+SLOW_API_MS = float(os.getenv("SLOW_API_MS", 2000))
+SLOW_HTTP_MS = float(os.getenv("SLOW_HTTP_MS", 1000))
+SLOW_LOG_SIZE = int(os.getenv("SLOW_LOG_SIZE", 500))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+# ===================== METRICS ==============================
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SWEEP_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 900, 1800)
+
+def format_labels(names, values, extra=""):
+    """Prometheus label set: {a="x",b="y"}"""
+    escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """Monotonic counter with optional labels (Prometheus text format)"""
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
         self.lock = threading.Lock()
+        METRICS.append(self)
     
-    def get_connection(self, thread_id):
-        """Get thread-specific database connection"""
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
         with self.lock:
-            if thread_id not in self.connections:
-                conn = sqlite3.connect("database/data.db", check_same_thread=False)
-                conn.row_factory = sqlite3.Row
-                self.connections[thread_id] = conn
-            return self.connections[thread_id]
+            self.values[key] = self.values.get(key, 0) + amount
     
-    def close_all(self):
-        """Close all connections"""
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
         with self.lock:
-            for conn in self.connections.values():
-                conn.close()
-            self.connections.clear()
+            values = self.values or ({(): 0} if not self.labels else {})
+            for key, value in sorted(values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, key)} {value:g}")
+        return lines
+
+class Histogram:
+    """Bucketed latency histogram with optional labels (Prometheus text format)"""
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.series = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self.lock = threading.Lock()
+        METRICS.append(self)
+    
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+    
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of a with-block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = {key: list(values) for key, values in self.series.items()}
+        for key, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound:g}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {values[-1]:.6f}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {cumulative}")
+        return lines
 
-# Global database manager
-db_manager = Database()
+METRICS = []
 
-def get_db():
-    """Get database connection for current thread"""
-    thread_id = threading.get_ident()
-    return db_manager.get_connection(thread_id)
+def render_metrics():
+    """All registered metrics in Prometheus text exposition format"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
 
-def init_database():
-    """Initialize database tables"""
-    db = get_db()
-    cur = db.cursor()
+# Hot path latencies
+CHECK_MEMBER_SECONDS = Histogram("bot_check_member_seconds", "Membership check latency (cache or Bot API)", ["fresh"])
+API_REQUEST_SECONDS = Histogram("bot_api_request_seconds", "Bot API HTTP round trip", ["method"])
+SEND_SECONDS = Histogram("bot_send_seconds", "Outbound call from queueing to delivery", ["method"])
+DB_TRANSACTION_SECONDS = Histogram("bot_db_transaction_seconds", "SQLite transaction from BEGIN to commit/rollback", ["op", "outcome"])
+HANDLER_SECONDS = Histogram("bot_update_handler_seconds", "handler() run time per update type", ["type"])
+SWEEP_SECONDS = Histogram("bot_sweep_seconds", "Monitor sweep duration", buckets=SWEEP_BUCKETS)
+
+# Events
+API_ERRORS = Counter("bot_api_errors_total", "Bot API calls that failed or returned ok=false", ["method", "code"])
+STRIKES = Counter("bot_strikes_total", "Strikes given for leaving the channel")
+SUSPENSIONS = Counter("bot_suspensions_total", "Users suspended after MAX_STRIKES")
+DELETIONS = Counter("bot_deletions_total", "Users deleted after their suspension expired")
+RESTORES = Counter("bot_restores_total", "Suspended or deleted users restored after rejoining")
+NOTIFICATIONS_SENT = Counter("bot_notifications_sent_total", "Status notifications sent", ["kind"])
+NOTIFICATIONS_SUPPRESSED = Counter("bot_notifications_suppressed_total", "Status notifications skipped as repeats", ["kind"])
+
+class SlowLog:
+    """Recent operations over their threshold, with a timing breakdown.
     
-    # Main users table
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS users(
-            tg INTEGER,
-            uid TEXT,
-            status TEXT DEFAULT 'active',
-            added TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY(tg,uid)
-        )
-    """)
+    handler() calls and HTTP requests open a per-thread trace, so their
+    entries show how much of the time went to SQL and Bot API calls.
+    """
+    def __init__(self, size, thresholds):
+        self.entries = deque(maxlen=size)
+        self.thresholds = dict(thresholds)  # kind -> milliseconds
+        self.lock = threading.Lock()
+        self.local = threading.local()
     
-    # Enhanced user state table
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS user_states(
-            tg INTEGER PRIMARY KEY,
-            strike_count INTEGER DEFAULT 0,
-            last_check TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            suspended_until TIMESTAMP,
-            status TEXT DEFAULT 'active',
-            last_member_status TEXT DEFAULT 'member',
-            last_notified_status TEXT,
-            notifications_sent INTEGER DEFAULT 0,
-            created TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
+    def begin(self):
+        """Start collecting SQL/API time for the current thread"""
+        self.local.trace = {"sql_ms": 0.0, "sql_statements": 0, "api_ms": 0.0, "api_calls": 0}
     
-    # Deleted users log (for audit)
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS deleted_users_log(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            tg INTEGER,
-            deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            reason TEXT,
-            ids_count INTEGER
-        )
-    """)
+    def end(self):
+        """Stop collecting and return the breakdown (None if not tracing)"""
+        trace = getattr(self.local, "trace", None)
+        self.local.trace = None
+        return trace
+    
+    def add(self, kind, ms):
+        """Charge time to the current trace (kind: sql / api)"""
+        trace = getattr(self.local, "trace", None)
+        if trace is not None:
+            trace[f"{kind}_ms"] += ms
+            trace["sql_statements" if kind == "sql" else "api_calls"] += 1
+    
+    def is_slow(self, kind, ms):
+        return ms >= self.thresholds[kind]
+    
+    def record(self, kind, name, ms, **details):
+        entry = {
+            "at": datetime.now().isoformat(timespec="milliseconds"),
+            "kind": kind,
+            "name": name,
+            "ms": round(ms, 2),
+            "thread": threading.current_thread().name
+        }
+        entry.update({k: round(v, 2) if isinstance(v, float) else v for k, v in details.items()})
+        with self.lock:
+            self.entries.append(entry)
+        print(f"🐢 [SLOW] {kind} {name} took {ms:.0f}ms")
     
-    db.commit()
-    print("✅ Database initialized")
+    def recent(self, limit=100, kind=None):
+        """Newest entries first"""
+        with self.lock:
+            entries = [e for e in reversed(self.entries) if kind is None or e["kind"] == kind]
+        return entries[:limit]
 
-# Initialize database
-init_database()
+slow_log = SlowLog(SLOW_LOG_SIZE, {
+    "handler": SLOW_HANDLER_MS,
+    "sql": SLOW_SQL_MS,
+    "api": SLOW_API_MS,
+    "http": SLOW_HTTP_MS
+})
 
-# ===================== DATABASE FUNCTIONS ====================
-def ensure_user_state(tg):
-    """CRITICAL FIX #1: Ensure user has entry in user_states"""
-    db = get_db()
-    cur = db.cursor()
+def sql_summary(sql):
+    """One-line statement text for logs"""
+    return " ".join(sql.split())[:200]
+
+# ===================== DATABASE =============================
+os.makedirs(os.path.dirname(DB_PATH) or ".", exist_ok=True)
+
+def apply_storage_profile(conn):
+    """WAL journal plus cache/mmap/busy tuning for a new connection"""
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that times each statement and notes when one opens a transaction"""
+    def _timed(self, run, sql, parameters):
+        conn = self.connection
+        began = not conn.in_transaction
+        started = time.perf_counter()
+        result = run(sql, parameters)
+        if began and conn.in_transaction:
+            conn.tx_started = started
+        ms = (time.perf_counter() - started) * 1000
+        slow_log.add("sql", ms)
+        if slow_log.is_slow("sql", ms):
+            caller = sys._getframe(2)
+            while caller.f_code.co_name in ("execute", "executemany"):
+                caller = caller.f_back
+            slow_log.record("sql", sql_summary(sql), ms, op=caller.f_code.co_name,
+                            rows=self.rowcount, in_transaction=conn.in_transaction)
+        return result
     
-    # Check if user exists
-    cur.execute("SELECT 1 FROM user_states WHERE tg=?", (tg,))
-    if not cur.fetchone():
-        # Create entry if doesn't exist
-        cur.execute("""
-            INSERT OR IGNORE INTO user_states 
-            (tg, status, strike_count, last_member_status) 
-            VALUES(?,?,?,?)
-        """, (tg, 'active', 0, 'member'))
-        db.commit()
-        print(f"[USER_STATE] Created entry for user {tg}")
+    def execute(self, sql, parameters=()):
+        return self._timed(super().execute, sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self._timed(super().executemany, sql, seq_of_parameters)
 
-def add_id(tg, uid):
-    """Add ID for user"""
-    # CRITICAL: Ensure user state exists first
-    ensure_user_state(tg)
+class TimedConnection(sqlite3.Connection):
+    """Connection that reports each transaction to DB_TRANSACTION_SECONDS"""
+    tx_started = None
     
-    db = get_db()
-    cur = db.cursor()
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
     
-    # Use transaction for safety
-    try:
-        cur.execute("BEGIN IMMEDIATE")
-        cur.execute("""
-            INSERT OR IGNORE INTO users VALUES(?,?,?,datetime('now'))
-        """, (tg, uid, 'active'))
-        db.commit()
-        return True
-    except Exception as e:
-        db.rollback()
-        print(f"Error adding ID for {tg}: {e}")
-        return False
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+    
+    def _finish(self, outcome, op):
+        started, self.tx_started = self.tx_started, None
+        if started is not None:
+            DB_TRANSACTION_SECONDS.observe(time.perf_counter() - started, op=op, outcome=outcome)
+    
+    def commit(self):
+        super().commit()
+        # Labelled with the function that owns the transaction
+        self._finish("commit", sys._getframe(1).f_code.co_name)
+    
+    def rollback(self):
+        super().rollback()
+        self._finish("rollback", sys._getframe(1).f_code.co_name)
 
-def suspend_user(tg):
-    """Temporarily suspend user access"""
-    db = get_db()
-    cur = db.cursor()
+class ConnectionPool:
+    """Bounded SQLite pool: one writer connection and up to max_readers readers.
     
-    try:
-        cur.execute("BEGIN IMMEDIATE")
+    reader() / writer() check a connection out for a with-block and return
+    it afterwards. Both are reentrant per thread, and a thread holding the
+    writer reads through it, so it sees its own uncommitted changes.
+    Readers are query_only; idle ones are closed after idle_timeout.
+    """
+    def __init__(self, path, max_readers, timeout, idle_timeout):
+        self.path = path
+        self.max_readers = max_readers
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.cond = threading.Condition()
+        self.idle_readers = []  # (conn, returned_at), most recent last
+        self.readers_open = 0
+        self.writer_conn = None
+        self.writer_busy = False
+        self.local = threading.local()
+        self.counters = {"checkouts": 0, "waits": 0, "timeouts": 0, "created": 0, "evicted": 0,
+                         "abandoned_transactions": 0}
+        self.wait_ms = deque(maxlen=1000)
+    
+    def _connect(self, readonly):
+        conn = sqlite3.connect(self.path, check_same_thread=False, factory=TimedConnection)
+        conn.row_factory = sqlite3.Row
+        apply_storage_profile(conn)
+        if readonly:
+            conn.execute("PRAGMA query_only=1")
+        with self.cond:
+            self.counters["created"] += 1
+        return conn
+    
+    def _held(self):
+        held = getattr(self.local, "held", None)
+        if held is None:
+            held = self.local.held = {}
+        return held
+    
+    def _record_wait(self, started, waited):
+        self.counters["checkouts"] += 1
+        if waited:
+            self.counters["waits"] += 1
+        self.wait_ms.append((time.monotonic() - started) * 1000)
+    
+    def _evict_idle(self):
+        """Close readers idle longer than idle_timeout, keeping one warm (cond held)"""
+        cutoff = time.monotonic() - self.idle_timeout
+        while len(self.idle_readers) > 1 and self.idle_readers[0][1] < cutoff:
+            conn, _ = self.idle_readers.pop(0)
+            conn.close()
+            self.readers_open -= 1
+            self.counters["evicted"] += 1
+    
+    def _wait(self, ready, deadline, kind):
+        """Wait on cond until ready(); True if we had to wait (cond held)"""
+        waited = False
+        while not ready():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.counters["timeouts"] += 1
+                raise TimeoutError(f"No SQLite {kind} connection free after {self.timeout:g}s")
+            waited = True
+            self.cond.wait(remaining)
+        return waited
+    
+    def _checkout_reader(self):
+        started = time.monotonic()
+        with self.cond:
+            self._evict_idle()
+            waited = self._wait(lambda: self.idle_readers or self.readers_open < self.max_readers,
+                                started + self.timeout, "reader")
+            self._record_wait(started, waited)
+            if self.idle_readers:
+                return self.idle_readers.pop()[0]
+            self.readers_open += 1
+        try:
+            return self._connect(readonly=True)
+        except Exception:
+            with self.cond:
+                self.readers_open -= 1
+                self.cond.notify()
+            raise
+    
+    def _checkin_reader(self, conn):
+        with self.cond:
+            self.idle_readers.append((conn, time.monotonic()))
+            self._evict_idle()
+            self.cond.notify()
+    
+    def _checkout_writer(self):
+        started = time.monotonic()
+        with self.cond:
+            waited = self._wait(lambda: not self.writer_busy, started + self.timeout, "writer")
+            self._record_wait(started, waited)
+            self.writer_busy = True
+            conn = self.writer_conn
+        if conn is None:
+            try:
+                conn = self.writer_conn = self._connect(readonly=False)
+            except Exception:
+                self._checkin_writer(None)
+                raise
+        return conn
+    
+    def _checkin_writer(self, conn):
+        if conn is not None and conn.in_transaction:
+            # Never hand the next caller a half-finished transaction
+            conn.rollback()
+            with self.cond:
+                self.counters["abandoned_transactions"] += 1
+            print("[DB] Rolled back a transaction left open at writer checkin")
+        with self.cond:
+            self.writer_busy = False
+            self.cond.notify_all()
+    
+    @contextmanager
+    def _lease(self, kind):
+        held = self._held()
+        # Reuse what this thread already holds; the writer also serves reads
+        for candidate in ("writer", "reader") if kind == "reader" else ("writer",):
+            if candidate in held:
+                entry = held[candidate]
+                entry[1] += 1
+                try:
+                    yield entry[0]
+                finally:
+                    entry[1] -= 1
+                return
         
-        # Check if already suspended
-        cur.execute("SELECT status FROM user_states WHERE tg=?", (tg,))
-        current_status = cur.fetchone()
+        conn = self._checkout_writer() if kind == "writer" else self._checkout_reader()
+        held[kind] = [conn, 1]
+        try:
+            yield conn
+        finally:
+            del held[kind]
+            if kind == "writer":
+                self._checkin_writer(conn)
+            else:
+                self._checkin_reader(conn)
+    
+    def reader(self):
+        """Check out a read-only connection (keep it short; page big reads, one checkout per batch)"""
+        return self._lease("reader")
+    
+    def writer(self):
+        """Check out the single writer connection"""
+        return self._lease("writer")
+    
+    def stats(self):
+        """Pool occupancy, checkout waits and churn"""
+        with self.cond:
+            stats = dict(self.counters)
+            stats.update({
+                "max_readers": self.max_readers,
+                "readers_open": self.readers_open,
+                "readers_idle": len(self.idle_readers),
+                "readers_in_use": self.readers_open - len(self.idle_readers),
+                "writer_busy": self.writer_busy,
+                "wait_ms": percentiles(self.wait_ms)
+            })
+        return stats
+    
+    def close_all(self):
+        """Close idle readers and the writer"""
+        with self.cond:
+            for conn, _ in self.idle_readers:
+                conn.close()
+            self.readers_open -= len(self.idle_readers)
+            self.idle_readers.clear()
+            if self.writer_conn is not None and not self.writer_busy:
+                self.writer_conn.close()
+                self.writer_conn = None
+
+db_pool = ConnectionPool(DB_PATH, DB_POOL_READERS, DB_POOL_TIMEOUT, DB_POOL_IDLE_TIMEOUT)
+
+def init_database():
+    """Initialize database tables"""
+    with db_pool.writer() as db:
+        cur = db.cursor()
         
-        if current_status and current_status['status'] == 'suspended':
-            return
+        # Main users table
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS users(
+                tg INTEGER,
+                uid TEXT,
+                status TEXT DEFAULT 'active',
+                added TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY(tg,uid)
+            )
+        """)
         
-        # Suspend user
-        suspend_time = datetime.now() + timedelta(seconds=SUSPEND_DURATION)
+        # Enhanced user state table
         cur.execute("""
-            UPDATE user_states 
-            SET strike_count=?, suspended_until=?, status=?, 
-                last_member_status='left', last_notified_status='suspended'
-            WHERE tg=?
-        """, (MAX_STRIKES, suspend_time, 'suspended', tg))
+            CREATE TABLE IF NOT EXISTS user_states(
+                tg INTEGER PRIMARY KEY,
+                strike_count INTEGER DEFAULT 0,
+                last_check TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                suspended_until TIMESTAMP,
+                status TEXT DEFAULT 'active',
+                last_member_status TEXT DEFAULT 'member',
+                last_notified_status TEXT,
+                notifications_sent INTEGER DEFAULT 0,
+                created TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
         
-        # Update all user's IDs to suspended
+        # Deleted users log (for audit)
         cur.execute("""
-            UPDATE users SET status='suspended' WHERE tg=?
-        """, (tg,))
+            CREATE TABLE IF NOT EXISTS deleted_users_log(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tg INTEGER,
+                deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                reason TEXT,
+                ids_count INTEGER
+            )
+        """)
         
         db.commit()
-        
-    except Exception as e:
-        db.rollback()
-        print(f"Error suspending user {tg}: {e}")
+        migrate_database(db)
+        print("✅ Database initialized")
 
-def delete_user_ids(tg):
-    """Permanently delete user's IDs with double-check and logging"""
-    db = get_db()
+# Schema migrations, tracked by PRAGMA user_version (migration N sets it to N)
+MIGRATIONS = [
+    # 1: indexes for the hot read paths
+    [
+        # get_active_users: WHERE status ORDER BY last_check (tg is the rowid)
+        "CREATE INDEX IF NOT EXISTS idx_user_states_status_check ON user_states(status, last_check)",
+        # users with pending strikes: small partial index
+        """CREATE INDEX IF NOT EXISTS idx_user_states_struck ON user_states(strike_count, last_check)
+           WHERE status='active' AND strike_count > 0""",
+        # get_suspended_users: WHERE status ORDER BY suspended_until
+        "CREATE INDEX IF NOT EXISTS idx_user_states_suspended ON user_states(status, suspended_until)",
+        # per-user COUNT(*) WHERE tg=? AND status='active'
+        "CREATE INDEX IF NOT EXISTS idx_users_tg_status ON users(tg, status)",
+        # admin panel: ORDER BY deleted_at DESC
+        "CREATE INDEX IF NOT EXISTS idx_deleted_log_deleted_at ON deleted_users_log(deleted_at)",
+    ],
+    # 2: incrementally maintained counters for /count, /health and get_stats()
+    [
+        "CREATE TABLE IF NOT EXISTS counters(name TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0)",
+        "CREATE TABLE IF NOT EXISTS daily_added(day TEXT PRIMARY KEY, count INTEGER NOT NULL DEFAULT 0)",
+        """CREATE TABLE IF NOT EXISTS user_id_counts(
+               tg INTEGER PRIMARY KEY,
+               active INTEGER NOT NULL DEFAULT 0,
+               suspended INTEGER NOT NULL DEFAULT 0
+           )""",
+        # Backfill from existing rows before the triggers take over
+        """INSERT OR REPLACE INTO user_id_counts(tg, active, suspended)
+           SELECT tg, SUM(status='active'), SUM(status='suspended') FROM users GROUP BY tg""",
+        "DELETE FROM counters",
+        """INSERT INTO counters(name, value) VALUES
+           ('ids_total', (SELECT COUNT(*) FROM users)),
+           ('ids_active', (SELECT COUNT(*) FROM users WHERE status='active')),
+           ('users_active', (SELECT COUNT(*) FROM user_id_counts WHERE active > 0)),
+           ('users_suspended', (SELECT COUNT(*) FROM user_id_counts WHERE suspended > 0)),
+           ('deleted_users', (SELECT COUNT(*) FROM deleted_users_log))""",
+        "DELETE FROM daily_added",
+        "INSERT INTO daily_added(day, count) SELECT date(added), COUNT(*) FROM users GROUP BY date(added)",
+        """CREATE TRIGGER IF NOT EXISTS trg_users_counters_insert AFTER INSERT ON users BEGIN
+               INSERT OR IGNORE INTO user_id_counts(tg) VALUES(NEW.tg);
+               UPDATE user_id_counts
+                   SET active = active + (NEW.status='active'),
+                       suspended = suspended + (NEW.status='suspended')
+                   WHERE tg = NEW.tg;
+               UPDATE counters SET value = value + 1 WHERE name = 'ids_total';
+               UPDATE counters SET value = value + (NEW.status='active') WHERE name = 'ids_active';
+               INSERT OR IGNORE INTO daily_added(day) VALUES(date(NEW.added));
+               UPDATE daily_added SET count = count + 1 WHERE day = date(NEW.added);
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_users_counters_delete AFTER DELETE ON users BEGIN
+               UPDATE user_id_counts
+                   SET active = active - (OLD.status='active'),
+                       suspended = suspended - (OLD.status='suspended')
+                   WHERE tg = OLD.tg;
+               UPDATE counters SET value = value - 1 WHERE name = 'ids_total';
+               UPDATE counters SET value = value - (OLD.status='active') WHERE name = 'ids_active';
+               UPDATE daily_added SET count = count - 1 WHERE day = date(OLD.added);
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_users_counters_status AFTER UPDATE OF status ON users
+           WHEN OLD.status IS NOT NEW.status BEGIN
+               UPDATE user_id_counts
+                   SET active = active + (NEW.status='active') - (OLD.status='active'),
+                       suspended = suspended + (NEW.status='suspended') - (OLD.status='suspended')
+                   WHERE tg = NEW.tg;
+               UPDATE counters SET value = value + (NEW.status='active') - (OLD.status='active')
+                   WHERE name = 'ids_active';
+           END""",
+        # Distinct-user counters follow each user's active/suspended ID counts
+        """CREATE TRIGGER IF NOT EXISTS trg_user_id_counts_users AFTER UPDATE ON user_id_counts BEGIN
+               UPDATE counters SET value = value + (NEW.active > 0) - (OLD.active > 0)
+                   WHERE name = 'users_active';
+               UPDATE counters SET value = value + (NEW.suspended > 0) - (OLD.suspended > 0)
+                   WHERE name = 'users_suspended';
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_deleted_log_counters AFTER INSERT ON deleted_users_log BEGIN
+               UPDATE counters SET value = value + 1 WHERE name = 'deleted_users';
+           END""",
+    ],
+    # 3: adaptive check schedule (unix time of next check, consecutive member checks)
+    [
+        "ALTER TABLE user_states ADD COLUMN next_check REAL",
+        "ALTER TABLE user_states ADD COLUMN stable_checks INTEGER DEFAULT 0",
+    ],
+    # 4: named leases for single-leader background work across processes
+    [
+        """CREATE TABLE IF NOT EXISTS leases(
+               name TEXT PRIMARY KEY,
+               owner TEXT NOT NULL,
+               expires_at REAL NOT NULL,
+               acquired_at REAL NOT NULL
+           )""",
+    ],
+    # 5: version of the public (active) ID list, bumped whenever it changes
+    [
+        "INSERT OR IGNORE INTO counters(name, value) VALUES('ids_version', 0)",
+        """CREATE TRIGGER IF NOT EXISTS trg_users_version_insert AFTER INSERT ON users
+           WHEN NEW.status='active' BEGIN
+               UPDATE counters SET value = value + 1 WHERE name = 'ids_version';
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_users_version_delete AFTER DELETE ON users
+           WHEN OLD.status='active' BEGIN
+               UPDATE counters SET value = value + 1 WHERE name = 'ids_version';
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_users_version_status AFTER UPDATE OF status ON users
+           WHEN (OLD.status='active') <> (NEW.status='active') BEGIN
+               UPDATE counters SET value = value + 1 WHERE name = 'ids_version';
+           END""",
+    ],
+    # 6: append-only change log behind /changes (compacted up to changes_floor)
+    [
+        """CREATE TABLE IF NOT EXISTS id_changes(
+               seq INTEGER PRIMARY KEY AUTOINCREMENT,
+               tg INTEGER NOT NULL,
+               uid TEXT NOT NULL,
+               op TEXT NOT NULL,
+               status TEXT,
+               at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+           )""",
+        "INSERT OR IGNORE INTO counters(name, value) VALUES('changes_floor', 0)",
+        """CREATE TRIGGER IF NOT EXISTS trg_users_changes_insert AFTER INSERT ON users BEGIN
+               INSERT INTO id_changes(tg, uid, op, status) VALUES(NEW.tg, NEW.uid, 'added', NEW.status);
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_users_changes_delete AFTER DELETE ON users BEGIN
+               INSERT INTO id_changes(tg, uid, op, status) VALUES(OLD.tg, OLD.uid, 'deleted', NULL);
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_users_changes_status AFTER UPDATE OF status ON users
+           WHEN OLD.status IS NOT NEW.status BEGIN
+               INSERT INTO id_changes(tg, uid, op, status)
+               VALUES(NEW.tg, NEW.uid, CASE NEW.status WHEN 'active' THEN 'restored' ELSE NEW.status END,
+                      NEW.status);
+           END""",
+    ],
+    # 7: schedule changes for users in shards another process owns
+    [
+        """CREATE TABLE IF NOT EXISTS schedule_nudges(
+               tg INTEGER PRIMARY KEY,
+               due REAL NOT NULL,
+               interval REAL NOT NULL
+           )""",
+    ],
+    # 8: id_changes remembers the status before each change, so the public
+    # feed can show only moves into or out of 'active'
+    [
+        "ALTER TABLE id_changes ADD COLUMN prev_status TEXT",
+        "DROP TRIGGER IF EXISTS trg_users_changes_delete",
+        "DROP TRIGGER IF EXISTS trg_users_changes_status",
+        """CREATE TRIGGER trg_users_changes_delete AFTER DELETE ON users BEGIN
+               INSERT INTO id_changes(tg, uid, op, status, prev_status)
+               VALUES(OLD.tg, OLD.uid, 'deleted', NULL, OLD.status);
+           END""",
+        """CREATE TRIGGER trg_users_changes_status AFTER UPDATE OF status ON users
+           WHEN OLD.status IS NOT NEW.status BEGIN
+               INSERT INTO id_changes(tg, uid, op, status, prev_status)
+               VALUES(NEW.tg, NEW.uid, CASE NEW.status WHEN 'active' THEN 'restored' ELSE NEW.status END,
+                      NEW.status, OLD.status);
+           END""",
+    ],
+    # 9: compaction finds the retention cut-off by time without a full scan
+    [
+        "CREATE INDEX IF NOT EXISTS idx_id_changes_at ON id_changes(at)",
+    ],
+]
+
+def migrate_database(db):
+    """Apply pending schema migrations (idempotent, safe across processes)"""
     cur = db.cursor()
-    
-    try:
+    migrated = False
+    for number, statements in enumerate(MIGRATIONS, start=1):
         cur.execute("BEGIN IMMEDIATE")
-        
-        # CRITICAL FIX #2: Get count before deletion (for logging)
-        cur.execute("SELECT COUNT(*) as count FROM users WHERE tg=?", (tg,))
-        ids_count = cur.fetchone()['count']
-        
-        # Enterprise feature: Double-check before deletion
-        if DOUBLE_CHECK_DELETE:
-            # Final verification before deletion
-            is_member = check_member(tg)
-            if is_member:
-                print(f"[ENTERPRISE] User {tg} rejoined at last moment, cancelling deletion")
-                
-                # Restore user
-                cur.execute("""
-                    UPDATE user_states 
-                    SET strike_count=0, status='active', suspended_until=NULL,
-                        last_member_status='member'
-                    WHERE tg=?
-                """, (tg,))
-                
-                cur.execute("""
-                    UPDATE users SET status='active' WHERE tg=?
-                """, (tg,))
-                
-                db.commit()
-                return False
-        
-        # CRITICAL FIX #2: Log deletion first
-        cur.execute("""
-            INSERT INTO deleted_users_log (tg, reason, ids_count)
-            VALUES(?,?,?)
-        """, (tg, 'channel_leave', ids_count))
-        
-        # CRITICAL FIX #2: Update status to 'deleted' before actual deletion
-        cur.execute("""
-            UPDATE user_states SET status='deleted' WHERE tg=?
-        """, (tg,))
-        db.commit()
-        
-        # Now delete the data
-        cur.execute("DELETE FROM users WHERE tg=?", (tg,))
-        cur.execute("DELETE FROM user_states WHERE tg=?", (tg,))
-        
+        # Re-read under the write lock in case another process migrated first
+        if cur.execute("PRAGMA user_version").fetchone()[0] >= number:
+            db.rollback()
+            continue
+        try:
+            for statement in statements:
+                cur.execute(statement)
+            cur.execute(f"PRAGMA user_version={number}")
+            db.commit()
+            migrated = True
+            print(f"✅ Database migrated to v{number}")
+        except Exception:
+            db.rollback()
+            raise
+    # Planner statistics: full refresh after schema changes, cheap top-up otherwise
+    cur.execute("ANALYZE" if migrated else "PRAGMA optimize")
+
+# Initialize database
+init_database()
+
+# ===================== DATABASE FUNCTIONS ====================
+def parse_timestamp(value):
+    """Parse a stored TIMESTAMP (with or without microseconds)"""
+    return datetime.fromisoformat(value)
+
+class KnownUsers:
+    """Bounded LRU of user ids known to have a user_states row.
+    
+    Kept in step by this process's create/delete paths; entries older than
+    ttl are re-verified since another process may have deleted the user.
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # tg -> verified_at (monotonic)
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "removals": 0}
+    
+    def load(self):
+        """Warm from user_states, most recently created users first"""
+        with db_pool.reader() as db:
+            rows = db.execute("SELECT tg FROM user_states ORDER BY rowid DESC LIMIT ?",
+                              (self.max_size,)).fetchall()
+        now = time.monotonic()
+        with self.lock:
+            for row in reversed(rows):
+                self.entries[row['tg']] = now
+                self.entries.move_to_end(row['tg'])
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        print(f"[USER_STATE] Known-user index warmed with {len(rows)} users")
+    
+    def contains(self, tg):
+        """True if tg recently had a user_states row"""
+        with self.lock:
+            verified_at = self.entries.get(tg)
+            if verified_at is not None and time.monotonic() - verified_at < self.ttl:
+                self.entries.move_to_end(tg)
+                self.counters["hits"] += 1
+                return True
+            self.counters["misses"] += 1
+            return False
+    
+    def add(self, *tgs):
+        now = time.monotonic()
+        with self.lock:
+            for tg in tgs:
+                self.entries[tg] = now
+                self.entries.move_to_end(tg)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.counters["evictions"] += 1
+    
+    def discard(self, *tgs):
+        with self.lock:
+            for tg in tgs:
+                if self.entries.pop(tg, None) is not None:
+                    self.counters["removals"] += 1
+    
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["size"] = len(self.entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+known_users = KnownUsers(KNOWN_USERS_SIZE, KNOWN_USERS_TTL)
+
+def create_user_state(cur, tg):
+    """INSERT OR IGNORE a user's user_states row on cur; True if it was created"""
+    cur.execute("""
+        INSERT OR IGNORE INTO user_states 
+        (tg, status, strike_count, last_member_status) 
+        VALUES(?,?,?,?)
+    """, (tg, 'active', 0, 'member'))
+    return cur.rowcount == 1
+
+def user_state_committed(tg, created):
+    """Bookkeeping once a user_states row is known to exist"""
+    known_users.add(tg)
+    if created:
+        scheduler.schedule(tg, time.time() + SCAN_TIME, SCAN_TIME)
+        print(f"[USER_STATE] Created entry for user {tg}")
+
+def ensure_user_state(tg):
+    """CRITICAL FIX #1: Ensure user has entry in user_states"""
+    # Hot path: users we have seen skip the database entirely. Writers of
+    # users rows still create the row in their own transaction, because
+    # another process may have deleted the user since we saw them.
+    if known_users.contains(tg):
+        return
+    
+    with db_pool.writer() as db:
+        cur = db.cursor()
+        # Create entry if doesn't exist (a no-op for existing users)
+        created = create_user_state(cur, tg)
         db.commit()
-        print(f"[DELETE] User {tg} deleted with {ids_count} IDs")
-        return True
+    
+    user_state_committed(tg, created)
+
+def add_id(tg, uid):
+    """Add ID for user"""
+    with db_pool.writer() as db:
+        cur = db.cursor()
         
-    except Exception as e:
-        db.rollback()
-        print(f"Error deleting user {tg}: {e}")
-        return False
+        # Use transaction for safety
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            # CRITICAL: the user state is created with the ID, never without it
+            created = create_user_state(cur, tg)
+            cur.execute("""
+                INSERT OR IGNORE INTO users VALUES(?,?,?,datetime('now'))
+            """, (tg, uid, 'active'))
+            inserted = cur.rowcount
+            db.commit()
+            user_state_committed(tg, created)
+            if inserted:
+                id_counts.adjust(tg, inserted)
+            return True
+        except Exception as e:
+            db.rollback()
+            print(f"Error adding ID for {tg}: {e}")
+            return False
 
-def restore_user(tg):
-    """Restore user access after rejoining"""
-    db = get_db()
-    cur = db.cursor()
+def parse_id_lines(lines):
+    """Yield IDs from an uploaded list (one per line; commas/spaces also split, '#' lines skipped)"""
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", "replace")
+        line = line.lstrip("\ufeff").strip()
+        if not line or line.startswith("#"):
+            continue
+        yield from line.replace(",", " ").split()
+
+def insert_id_batch(tg, rows):
+    """Insert a user's (tg, uid, status) rows in one transaction; returns rows actually added"""
+    with db_pool.writer() as db:
+        cur = db.cursor()
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            created = create_user_state(cur, tg)
+            cur.executemany("INSERT OR IGNORE INTO users VALUES(?,?,?,datetime('now'))", rows)
+            inserted = cur.rowcount
+            db.commit()
+            user_state_committed(tg, created)
+            return inserted
+        except Exception:
+            db.rollback()
+            raise
+
+def import_ids(tg, lines):
+    """Bulk-add IDs for a user from an iterable of lines; returns a summary dict.
+    
+    IDs are deduplicated in memory and written IMPORT_BATCH_SIZE per
+    transaction, so the writer is released between batches.
+    """
+    started = time.perf_counter()
+    # IDs of a suspended user stay suspended until they rejoin
+    status = 'suspended' if get_user_status(tg) == 'suspended' else 'active'
+    summary = {"read": 0, "invalid": 0, "duplicates": 0, "inserted": 0, "existing": 0,
+               "batches": 0, "truncated": False}
+    seen = set()
+    batch = []
+    
+    def capped(lines):
+        # Junk and duplicate lines never reach IMPORT_MAX_IDS, so cap the read too.
+        # A chunked body over MAX_CONTENT_LENGTH ends the read; its last line may be cut off.
+        pending = None
+        try:
+            for count, line in enumerate(lines, 1):
+                if count > IMPORT_MAX_LINES:
+                    summary["truncated"] = True
+                    break
+                if pending is not None:
+                    yield pending
+                pending = line
+        except RequestEntityTooLarge:
+            summary["truncated"] = True
+            return
+        if pending is not None:
+            yield pending
     
     try:
-        cur.execute("BEGIN IMMEDIATE")
+        for uid in parse_id_lines(capped(lines)):
+            summary["read"] += 1
+            if len(uid) > IMPORT_MAX_ID_LENGTH or uid.startswith("/"):
+                summary["invalid"] += 1
+                continue
+            if uid in seen:
+                summary["duplicates"] += 1
+                continue
+            if len(seen) >= IMPORT_MAX_IDS:
+                summary["truncated"] = True
+                break
+            seen.add(uid)
+            batch.append((tg, uid, status))
+            
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                inserted = insert_id_batch(tg, batch)
+                summary["inserted"] += inserted
+                summary["existing"] += len(batch) - inserted
+                summary["batches"] += 1
+                id_counts.adjust(tg, inserted if status == 'active' else 0)
+                batch = []
         
-        # Check if user was deleted but still in log
-        cur.execute("SELECT status FROM user_states WHERE tg=?", (tg,))
-        state = cur.fetchone()
+        if batch:
+            inserted = insert_id_batch(tg, batch)
+            summary["inserted"] += inserted
+            summary["existing"] += len(batch) - inserted
+            summary["batches"] += 1
+            id_counts.adjust(tg, inserted if status == 'active' else 0)
+    except Exception as e:
+        print(f"Error importing IDs for {tg}: {e}")
+        summary["error"] = str(e)
+    
+    summary["seconds"] = round(time.perf_counter() - started, 3)
+    print(f"[IMPORT] User {tg}: {summary['inserted']} added, {summary['existing']} existing, "
+          f"{summary['duplicates']} duplicates, {summary['invalid']} invalid in {summary['seconds']}s")
+    return summary
+
+def suspend_user(tg):
+    """Temporarily suspend user access"""
+    with db_pool.writer() as db:
+        cur = db.cursor()
         
-        if state and state['status'] == 'deleted':
-            # User was marked as deleted but data might still exist
-            # Just create new entry
-            cur.execute("""
-                INSERT OR REPLACE INTO user_states 
-                (tg, strike_count, status, last_member_status) 
-                VALUES(?,?,?,?)
-            """, (tg, 0, 'active', 'member'))
-        else:
-            # Normal restore
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            
+            # Check if already suspended
+            cur.execute("SELECT status FROM user_states WHERE tg=?", (tg,))
+            current_status = cur.fetchone()
+            
+            if current_status and current_status['status'] == 'suspended':
+                db.rollback()
+                return
+            
+            # Suspend user
+            suspend_time = datetime.now() + timedelta(seconds=SUSPEND_DURATION)
             cur.execute("""
                 UPDATE user_states 
-                SET strike_count=0, status='active', suspended_until=NULL, 
-                    last_member_status='member', last_notified_status='restored'
+                SET strike_count=?, suspended_until=?, status=?, 
+                    last_member_status='left', last_notified_status='suspended'
                 WHERE tg=?
+            """, (MAX_STRIKES, suspend_time, 'suspended', tg))
+            
+            # Update all user's IDs to suspended
+            cur.execute("""
+                UPDATE users SET status='suspended' WHERE tg=?
             """, (tg,))
-        
-        # Reactivate all suspended IDs
-        cur.execute("""
-            UPDATE users SET status='active' WHERE tg=? AND status='suspended'
-        """, (tg,))
-        
-        db.commit()
-        return True
-        
-    except Exception as e:
-        db.rollback()
-        print(f"Error restoring user {tg}: {e}")
-        return False
+            
+            db.commit()
+            SUSPENSIONS.inc()
+            id_counts.invalidate(tg)
+            scheduler.remove(tg)
+            expiry.schedule(tg, suspend_time.timestamp())
+            
+        except Exception as e:
+            db.rollback()
+            print(f"Error suspending user {tg}: {e}")
 
-def update_strike(tg, is_member):
-    """Update strike count based on membership check"""
-    db = get_db()
-    cur = db.cursor()
+def expire_suspensions(tgs):
+    """Double-check and permanently delete a batch of users, with logging.
     
-    try:
-        cur.execute("BEGIN IMMEDIATE")
-        
-        # Get current state
-        cur.execute("SELECT * FROM user_states WHERE tg=?", (tg,))
-        state = cur.fetchone()
+    Returns (deleted, rejoined, unknown). Users who rejoined are restored;
+    users whose membership could not be checked are left untouched.
+    """
+    # Enterprise feature: final verification, done before taking the write lock
+    if DOUBLE_CHECK_DELETE:
+        checks = list(sweep_executor.map(lambda tg: check_member(tg, fresh=True), tgs))
+    else:
+        checks = [False] * len(tgs)
+    rejoined = [tg for tg, is_member in zip(tgs, checks) if is_member]
+    leaving = [tg for tg, is_member in zip(tgs, checks) if is_member is False]
+    unknown = [tg for tg, is_member in zip(tgs, checks) if is_member is None]
+    
+    with db_pool.writer() as db:
+        cur = db.cursor()
+        next_check = time.time() + SCAN_TIME
         
-        if not state:
-            # Create entry if doesn't exist
-            cur.execute("""
-                INSERT INTO user_states 
-                (tg, last_member_status, last_check) 
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            
+            moved = {}  # tg -> new deadline, re-suspended since it was queued
+            # Skip users restored since their deadline fired ('deleted' rows are
+            # left over from an interrupted delete and are finished here)
+            cur.execute(f"""
+                SELECT tg, status, suspended_until FROM user_states 
+                WHERE status IN ('suspended','deleted') AND tg IN ({",".join("?" * len(tgs))})
+            """, tgs)
+            now = datetime.now()
+            still_suspended = set()
+            for row in cur.fetchall():
+                until = parse_timestamp(row['suspended_until']) if row['suspended_until'] else None
+                if row['status'] == 'deleted' or until is None or until <= now:
+                    still_suspended.add(row['tg'])
+                else:
+                    moved[row['tg']] = until.timestamp()
+            rejoined = [tg for tg in rejoined if tg in still_suspended]
+            leaving = [tg for tg in leaving if tg in still_suspended]
+            unknown = [tg for tg in unknown if tg not in moved]
+            
+            # Restore users who rejoined at the last moment
+            cur.executemany("""
+                UPDATE user_states 
+                SET strike_count=0, status='active', suspended_until=NULL,
+                    last_member_status='member', next_check=?, stable_checks=0
+                WHERE tg=?
+            """, [(next_check, tg) for tg in rejoined])
+            cur.executemany("UPDATE users SET status='active' WHERE tg=?", [(tg,) for tg in rejoined])
+            
+            # CRITICAL FIX #2: Get counts before deletion (for logging)
+            ids_counts = {}
+            if leaving:
+                cur.execute(f"""
+                    SELECT tg, COUNT(*) as count FROM users 
+                    WHERE tg IN ({",".join("?" * len(leaving))}) GROUP BY tg
+                """, leaving)
+                ids_counts = {row['tg']: row['count'] for row in cur.fetchall()}
+            
+            # CRITICAL FIX #2: Log deletion first
+            cur.executemany("""
+                INSERT INTO deleted_users_log (tg, reason, ids_count)
                 VALUES(?,?,?)
-            """, (tg, 'member' if is_member else 'left', datetime.now()))
+            """, [(tg, 'channel_leave', ids_counts.get(tg, 0)) for tg in leaving])
+            
+            # CRITICAL FIX #2: Update status to 'deleted' before actual deletion,
+            # in the same transaction so a failure cannot strand users half-deleted
+            cur.executemany("UPDATE user_states SET status='deleted' WHERE tg=?", [(tg,) for tg in leaving])
+            
+            # Now delete the data
+            cur.executemany("DELETE FROM users WHERE tg=?", [(tg,) for tg in leaving])
+            cur.executemany("DELETE FROM user_states WHERE tg=?", [(tg,) for tg in leaving])
             db.commit()
-            return 0, 'active'
+            
+        except Exception as e:
+            db.rollback()
+            print(f"Error deleting users {tgs[:5]}...: {e}")
+            return [], [], list(tgs)
         
-        # CRITICAL FIX #4: Update last_check even if API error
-        cur.execute("""
-            UPDATE user_states SET last_check=? WHERE tg=?
-        """, (datetime.now(), tg))
-        
-        # Check if user is suspended and time has passed
-        if state['status'] == 'suspended' and state['suspended_until']:
-            suspend_time = datetime.strptime(state['suspended_until'], '%Y-%m-%d %H:%M:%S')
-            if datetime.now() > suspend_time:
-                deleted = delete_user_ids(tg)
-                if deleted:
-                    return -1, 'deleted'
-                else:
-                    # Deletion cancelled, user restored
-                    return 0, 'active'
+        DELETIONS.inc(len(leaving))
+        RESTORES.inc(len(rejoined))
+        id_counts.invalidate(*rejoined, *leaving)
+        for tg in rejoined:
+            expiry.remove(tg)
+            scheduler.schedule(tg, next_check, SCAN_TIME)
+            print(f"[ENTERPRISE] User {tg} rejoined at last moment, cancelling deletion")
         
-        # If already deleted
-        if state['status'] == 'deleted':
-            return -1, 'deleted'
+        known_users.discard(*leaving)
+        for tg in leaving:
+            expiry.remove(tg)
+            scheduler.remove(tg)
+            print(f"[DELETE] User {tg} deleted with {ids_counts.get(tg, 0)} IDs")
         
-        if is_member:
-            # Reset strikes if member
-            cur.execute("""
-                UPDATE user_states 
-                SET strike_count=0, status='active', last_member_status='member'
-                WHERE tg=?
-            """, (tg,))
-            db.commit()
-            return 0, 'active'
-        else:
-            # Increment strike
-            new_strikes = state['strike_count'] + 1
-            new_status = state['status']
+        # Our deadline was stale (suspension renewed elsewhere): wait for the new one
+        for tg, due in moved.items():
+            expiry.schedule(tg, due)
+        
+        return leaving, rejoined, unknown
+
+def restore_user(tg):
+    """Restore user access after rejoining"""
+    with db_pool.writer() as db:
+        cur = db.cursor()
+        
+        # Recently restored users are checked often again
+        next_check = time.time() + SCAN_TIME
+        
+        try:
+            cur.execute("BEGIN IMMEDIATE")
             
-            # Suspend if max strikes reached
-            if new_strikes >= MAX_STRIKES and state['status'] != 'suspended':
-                new_status = 'suspended'
-                suspend_time = datetime.now() + timedelta(seconds=SUSPEND_DURATION)
+            # Check if user was deleted but still in log
+            cur.execute("SELECT status FROM user_states WHERE tg=?", (tg,))
+            state = cur.fetchone()
+            
+            if state and state['status'] == 'deleted':
+                # User was marked as deleted but data might still exist
+                # Just create new entry
                 cur.execute("""
-                    UPDATE user_states 
-                    SET strike_count=?, status=?, suspended_until=?, last_member_status='left'
-                    WHERE tg=?
-                """, (new_strikes, new_status, suspend_time, tg))
+                    INSERT OR REPLACE INTO user_states 
+                    (tg, strike_count, status, last_member_status, next_check, stable_checks) 
+                    VALUES(?,?,?,?,?,0)
+                """, (tg, 0, 'active', 'member', next_check))
             else:
+                # Normal restore
                 cur.execute("""
                     UPDATE user_states 
-                    SET strike_count=?, last_member_status='left'
+                    SET strike_count=0, status='active', suspended_until=NULL, 
+                        last_member_status='member', last_notified_status='restored',
+                        next_check=?, stable_checks=0
                     WHERE tg=?
-                """, (new_strikes, tg))
+                """, (next_check, tg))
             
-            db.commit()
-            return new_strikes, new_status
+            # Reactivate all suspended IDs
+            cur.execute("""
+                UPDATE users SET status='active' WHERE tg=? AND status='suspended'
+            """, (tg,))
             
-    except Exception as e:
-        db.rollback()
-        print(f"Error updating strike for {tg}: {e}")
-        return 0, 'error'
+            db.commit()
+            RESTORES.inc()
+            known_users.add(tg)
+            id_counts.invalidate(tg)
+            scheduler.schedule(tg, next_check, SCAN_TIME)
+            expiry.remove(tg)
+            return True
+            
+        except Exception as e:
+            db.rollback()
+            print(f"Error restoring user {tg}: {e}")
+            return False
+
+def update_strike(tg, is_member):
+    """Update strike count based on membership check"""
+    with db_pool.writer() as db:
+        cur = db.cursor()
+        
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            
+            # Get current state
+            cur.execute("SELECT * FROM user_states WHERE tg=?", (tg,))
+            state = cur.fetchone()
+            
+            if not state:
+                # Create entry if doesn't exist
+                cur.execute("""
+                    INSERT INTO user_states 
+                    (tg, last_member_status, last_check) 
+                    VALUES(?,?,?)
+                """, (tg, 'member' if is_member else 'left', datetime.now()))
+                db.commit()
+                known_users.add(tg)
+                return 0, 'active'
+            
+            # CRITICAL FIX #4: Update last_check even if API error
+            cur.execute("""
+                UPDATE user_states SET last_check=? WHERE tg=?
+            """, (datetime.now(), tg))
+            
+            # Suspension expiry is handled by the expiry engine, not here
+            
+            # If already deleted
+            if state['status'] == 'deleted':
+                db.commit()
+                return -1, 'deleted'
+            
+            if is_member:
+                restored = state['status'] == 'suspended'
+                if restored:
+                    # Rejoined while suspended: same as restore_user(), IDs come back too
+                    cur.execute("""
+                        UPDATE user_states 
+                        SET strike_count=0, status='active', suspended_until=NULL,
+                            last_member_status='member', last_notified_status='restored'
+                        WHERE tg=?
+                    """, (tg,))
+                    cur.execute("UPDATE users SET status='active' WHERE tg=? AND status='suspended'", (tg,))
+                else:
+                    # Reset strikes if member
+                    cur.execute("""
+                        UPDATE user_states 
+                        SET strike_count=0, status='active', last_member_status='member'
+                        WHERE tg=?
+                    """, (tg,))
+                db.commit()
+                expiry.remove(tg)
+                if restored:
+                    RESTORES.inc()
+                    id_counts.invalidate(tg)
+                return 0, 'active'
+            else:
+                # Increment strike
+                new_strikes = state['strike_count'] + 1
+                new_status = state['status']
+                
+                # Suspend if max strikes reached
+                if new_strikes >= MAX_STRIKES and state['status'] != 'suspended':
+                    new_status = 'suspended'
+                    suspend_time = datetime.now() + timedelta(seconds=SUSPEND_DURATION)
+                    cur.execute("""
+                        UPDATE user_states 
+                        SET strike_count=?, status=?, suspended_until=?, last_member_status='left'
+                        WHERE tg=?
+                    """, (new_strikes, new_status, suspend_time, tg))
+                else:
+                    cur.execute("""
+                        UPDATE user_states 
+                        SET strike_count=?, last_member_status='left'
+                        WHERE tg=?
+                    """, (new_strikes, tg))
+                
+                db.commit()
+                STRIKES.inc()
+                if new_status == 'suspended' and state['status'] != 'suspended':
+                    SUSPENSIONS.inc()
+                    expiry.schedule(tg, suspend_time.timestamp())
+                return new_strikes, new_status
+                
+        except Exception as e:
+            db.rollback()
+            print(f"Error updating strike for {tg}: {e}")
+            return 0, 'error'
 
 def get_user_status(tg):
     """Get user's current status"""
-    db = get_db()
-    cur = db.cursor()
-    cur.execute("SELECT status FROM user_states WHERE tg=?", (tg,))
-    result = cur.fetchone()
-    return result['status'] if result else 'active'
+    with db_pool.reader() as db:
+        cur = db.cursor()
+        cur.execute("SELECT status FROM user_states WHERE tg=?", (tg,))
+        result = cur.fetchone()
+        return result['status'] if result else 'active'
 
-def get_active_users():
-    """Get ONLY active users for monitoring"""
-    db = get_db()
-    cur = db.cursor()
-    cur.execute("""
-        SELECT tg FROM user_states 
-        WHERE status='active' 
-        ORDER BY last_check
-    """)
-    return [row['tg'] for row in cur.fetchall()]
+def get_user_state(tg):
+    """Strike count and status row for a user (None if not tracked)"""
+    with db_pool.reader() as db:
+        return db.execute("SELECT strike_count, status FROM user_states WHERE tg=?", (tg,)).fetchone()
+
+class IdCountCache:
+    """Bounded LRU of per-user active-ID counts over user_id_counts.
+    
+    The triggers keep user_id_counts exact inside each write transaction;
+    writers here call adjust()/invalidate() after commit. A read that raced
+    a write (generation moved on) is returned but not cached.
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # tg -> (count, expires_at)
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+    
+    def get(self, tg):
+        with self.lock:
+            entry = self.entries.get(tg)
+            if entry and entry[1] > time.monotonic():
+                self.entries.move_to_end(tg)
+                self.counters["hits"] += 1
+                return entry[0]
+            self.counters["misses"] += 1
+            generation = self.generation
+        
+        with db_pool.reader() as db:
+            row = db.execute("SELECT active FROM user_id_counts WHERE tg=?", (tg,)).fetchone()
+        count = row['active'] if row else 0
+        
+        with self.lock:
+            if self.generation == generation:
+                self.entries[tg] = (count, time.monotonic() + self.ttl)
+                self.entries.move_to_end(tg)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+                    self.counters["evictions"] += 1
+        return count
+    
+    def adjust(self, tg, delta):
+        """Apply a committed change to a cached count"""
+        with self.lock:
+            self.generation += 1
+            entry = self.entries.get(tg)
+            if entry:
+                self.entries[tg] = (max(entry[0] + delta, 0), entry[1])
+    
+    def invalidate(self, *tgs):
+        with self.lock:
+            self.generation += 1
+            for tg in tgs:
+                if self.entries.pop(tg, None) is not None:
+                    self.counters["invalidations"] += 1
+    
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["size"] = len(self.entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+id_counts = IdCountCache(ID_COUNT_CACHE_SIZE, ID_COUNT_TTL)
+
+def count_user_ids(tg):
+    """Number of active IDs a user has saved"""
+    return id_counts.get(tg)
+
+def get_recent_deletions(limit=10):
+    """Latest deleted_users_log entries (for admin panel)"""
+    with db_pool.reader() as db:
+        return db.execute("""
+            SELECT tg, deleted_at, ids_count 
+            FROM deleted_users_log 
+            ORDER BY deleted_at DESC 
+            LIMIT ?
+        """, (limit,)).fetchall()
+
+def get_active_users(limit=-1):
+    """Get ONLY active users for monitoring, least recently checked first"""
+    with db_pool.reader() as db:
+        cur = db.cursor()
+        cur.execute("""
+            SELECT tg FROM user_states 
+            WHERE status='active' 
+            ORDER BY last_check
+            LIMIT ?
+        """, (limit,))
+        return [row['tg'] for row in cur.fetchall()]
 
 def get_suspended_users():
     """Get suspended users (for admin panel)"""
-    db = get_db()
-    cur = db.cursor()
-    cur.execute("""
-        SELECT tg, suspended_until FROM user_states 
-        WHERE status='suspended'
-        ORDER BY suspended_until
-    """)
-    return cur.fetchall()
+    with db_pool.reader() as db:
+        cur = db.cursor()
+        cur.execute("""
+            SELECT tg, suspended_until FROM user_states 
+            WHERE status='suspended'
+            ORDER BY suspended_until
+        """)
+        return cur.fetchall()
 
 def should_send_notification(tg, notification_type):
     """Check if notification should be sent (prevents spam)"""
-    db = get_db()
+    with db_pool.writer() as db:
+        cur = db.cursor()
+        
+        cur.execute("""
+            SELECT last_notified_status, notifications_sent 
+            FROM user_states WHERE tg=?
+        """, (tg,))
+        result = cur.fetchone()
+        
+        if not result:
+            return True
+        
+        last_notified, sent_count = result['last_notified_status'], result['notifications_sent']
+        
+        # If same notification was already sent, don't send again
+        if last_notified == notification_type:
+            NOTIFICATIONS_SUPPRESSED.inc(kind=notification_type)
+            return False
+        
+        # Update notification tracking
+        cur.execute("""
+            UPDATE user_states 
+            SET last_notified_status=?, notifications_sent=notifications_sent+1
+            WHERE tg=?
+        """, (notification_type, tg))
+        db.commit()
+        
+        return True
+
+def get_stats():
+    """Get system statistics (constant-time reads of the counters tables)"""
+    with db_pool.reader() as db:
+        cur = db.cursor()
+        
+        row = cur.execute("""
+            SELECT
+                (SELECT value FROM counters WHERE name='ids_total'),
+                (SELECT value FROM counters WHERE name='users_active'),
+                (SELECT value FROM counters WHERE name='users_suspended'),
+                COALESCE((SELECT count FROM daily_added WHERE day=date('now')), 0),
+                (SELECT value FROM counters WHERE name='deleted_users')
+        """).fetchone()
+        total, active_users, suspended_users, today, deleted_count = row
+        
+        return total, active_users, suspended_users, today, deleted_count
+
+def get_counter(name):
+    """Read one maintained counter"""
+    with db_pool.reader() as db:
+        cur = db.cursor()
+        row = cur.execute("SELECT value FROM counters WHERE name=?", (name,)).fetchone()
+        return row[0] if row else 0
+
+def fetch_export_page(db, after, limit, status='active'):
+    """Up to limit (rowid, tg, uid, status, added) rows with rowid > after, on db"""
+    where = "rowid > ?" + (" AND status=?" if status else "")
+    params = [after] + ([status] if status else []) + [limit]
     cur = db.cursor()
+    cur.row_factory = None  # plain tuples, cheaper than sqlite3.Row per row
+    return cur.execute(f"""
+        SELECT rowid, tg, uid, status, added FROM users 
+        WHERE {where} 
+        ORDER BY rowid LIMIT ?
+    """, params).fetchall()
+
+def iter_export_rows(after=0, limit=None, status='active', batch_size=STREAM_BATCH_SIZE):
+    """Yield (rowid, tg, uid, status, added) batches with rowid > after (keyset pagination)
     
-    cur.execute("""
-        SELECT last_notified_status, notifications_sent 
-        FROM user_states WHERE tg=?
-    """, (tg,))
-    result = cur.fetchone()
+    Each batch is a short checkout of its own, so a slow client never holds a
+    pool reader between batches; pages resume after the last rowid sent.
+    """
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = batch_size if remaining is None else min(batch_size, remaining)
+        with db_pool.reader() as db:
+            rows = fetch_export_page(db, after, size, status)
+        if not rows:
+            break
+        yield rows
+        after = rows[-1][0]
+        if remaining is not None:
+            remaining -= len(rows)
+
+def export_next_after(after, limit, status='active'):
+    """Cursor for the page after this one (None when this page is the last)"""
+    where = "rowid > ?" + (" AND status=?" if status else "")
+    params = [after] + ([status] if status else []) + [limit - 1]
+    with db_pool.reader() as db:
+        # Last row of this page, plus the first of the next if there is one
+        rows = db.execute(f"""
+            SELECT rowid FROM users WHERE {where} ORDER BY rowid LIMIT 2 OFFSET ?
+        """, params).fetchall()
+    return rows[0][0] if len(rows) == 2 else None
+
+def latest_change_seq(db):
+    """Highest id_changes sequence number ever issued (survives compaction)"""
+    row = db.execute("SELECT seq FROM sqlite_sequence WHERE name='id_changes'").fetchone()
+    return row[0] if row else 0
+
+def get_changes(since, limit, public=True):
+    """(floor, latest, rows) for id_changes after since, read consistently.
     
-    if not result:
-        return True
+    public=True keeps only changes that move an ID into or out of the
+    active list served on /; admins get the full log.
+    """
+    visible = "AND (status IS 'active') <> (prev_status IS 'active')" if public else ""
+    with db_pool.reader() as db:
+        try:
+            db.execute("BEGIN")
+            floor = db.execute("SELECT value FROM counters WHERE name='changes_floor'").fetchone()[0]
+            latest = latest_change_seq(db)
+            rows = db.execute(f"""
+                SELECT seq, tg, uid, op, status, prev_status, at FROM id_changes 
+                WHERE seq > ? {visible} ORDER BY seq LIMIT ?
+            """, (since, limit)).fetchall()
+        finally:
+            db.rollback()
+    return floor, latest, rows
+
+def compact_changes(retention=CHANGES_RETENTION, max_rows=CHANGES_MAX_ROWS, chunk=50000):
+    """Drop id_changes older than retention or beyond max_rows; returns the new floor"""
+    with db_pool.reader() as db:
+        floor = db.execute("SELECT value FROM counters WHERE name='changes_floor'").fetchone()[0]
+        # The planner prefers walking seq backwards over every retained row;
+        # the index only touches the expired ones
+        by_age = db.execute("""
+            SELECT MAX(seq) FROM id_changes INDEXED BY idx_id_changes_at WHERE at < datetime('now', ?)
+        """, (f"-{retention} seconds",)).fetchone()[0] or 0
+        by_size = db.execute("SELECT seq FROM id_changes ORDER BY seq DESC LIMIT 1 OFFSET ?",
+                             (max_rows,)).fetchone()
+    upto = max(by_age, by_size[0] if by_size else 0)
     
-    last_notified, sent_count = result['last_notified_status'], result['notifications_sent']
+    # Chunked so the writer is never held for one huge delete
+    while floor < upto:
+        step = min(floor + chunk, upto)
+        with db_pool.writer() as db:
+            cur = db.cursor()
+            try:
+                cur.execute("BEGIN IMMEDIATE")
+                cur.execute("DELETE FROM id_changes WHERE seq <= ?", (step,))
+                cur.execute("UPDATE counters SET value = MAX(value, ?) WHERE name = 'changes_floor'", (step,))
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+        floor = step
+    return floor
+
+def count_active_ids():
+    """Count active IDs without materializing them"""
+    return get_counter('ids_active')
+
+# ================= TELEGRAM API =============================
+class BotTransport:
+    """Pooled keep-alive HTTP session shared by all Bot API calls"""
+    def __init__(self, base_url, file_url=None, pool_size=HTTP_POOL_SIZE):
+        self.base_url = base_url
+        self.file_url = file_url
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "retries": 0, "errors": 0}
     
-    # If same notification was already sent, don't send again
-    if last_notified == notification_type:
-        return False
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
     
-    # Update notification tracking
-    cur.execute("""
-        UPDATE user_states 
-        SET last_notified_status=?, notifications_sent=notifications_sent+1
-        WHERE tg=?
-    """, (notification_type, tg))
-    db.commit()
+    def call(self, method, payload=None):
+        """POST a Bot API method and return the decoded JSON body"""
+        timeout, retries = API_METHOD_POLICY.get(method, DEFAULT_API_POLICY)
+        started = time.perf_counter()
+        attempts_ms = []
+        try:
+            return self._call(method, payload, timeout, retries, attempts_ms)
+        finally:
+            ms = (time.perf_counter() - started) * 1000
+            slow_log.add("api", ms)
+            # getUpdates long-polls by design
+            if method != "getUpdates" and slow_log.is_slow("api", ms):
+                slow_log.record("api", method, ms, attempts_ms=[round(a, 1) for a in attempts_ms],
+                                backoff_ms=ms - sum(attempts_ms), timeout_s=timeout)
     
-    return True
-
-def get_stats():
-    """Get system statistics"""
-    db = get_db()
-    cur = db.cursor()
+    def _call(self, method, payload, timeout, retries, attempts_ms):
+        for attempt in range(retries + 1):
+            if attempt:
+                self._count("retries")
+                time.sleep(0.5 * 2 ** (attempt - 1))
+            
+            self._count("requests")
+            sent_at = time.perf_counter()
+            try:
+                with API_REQUEST_SECONDS.time(method=method):
+                    r = self.session.post(f"{self.base_url}/{method}", json=payload or {}, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                attempts_ms.append((time.perf_counter() - sent_at) * 1000)
+                self._count("errors")
+                API_ERRORS.inc(method=method, code="network")
+                if attempt == retries:
+                    raise
+                continue
+            
+            attempts_ms.append((time.perf_counter() - sent_at) * 1000)
+            
+            # Server-side failures are retried, API errors (4xx) are not
+            if r.status_code >= 500 and attempt < retries:
+                self._count("errors")
+                API_ERRORS.inc(method=method, code=r.status_code)
+                continue
+            
+            try:
+                body = r.json()
+            except ValueError:
+                self._count("errors")
+                body = {"ok": False, "error_code": r.status_code, "description": r.text[:200]}
+            if not body.get("ok"):
+                API_ERRORS.inc(method=method, code=body.get("error_code"))
+            return body
     
-    total = cur.execute("SELECT COUNT(*) FROM users").fetchone()[0]
-    active_users = cur.execute("""
-        SELECT COUNT(DISTINCT tg) FROM users WHERE status='active'
-    """).fetchone()[0]
-    suspended_users = cur.execute("""
-        SELECT COUNT(DISTINCT tg) FROM users WHERE status='suspended'
-    """).fetchone()[0]
-    today = cur.execute("""
-        SELECT COUNT(*) FROM users WHERE date(added)=date('now')
-    """).fetchone()[0]
-    deleted_count = cur.execute("SELECT COUNT(*) FROM deleted_users_log").fetchone()[0]
-    
-    return total, active_users, suspended_users, today, deleted_count
-
-def get_all_ids():
-    """Get all active IDs in plain format"""
-    db = get_db()
-    cur = db.cursor()
-    data = cur.execute("""
-        SELECT uid FROM users 
-        WHERE status='active' 
-        ORDER BY rowid
-    """).fetchall()
-    return [row['uid'] for row in data]
+    @contextmanager
+    def open_file(self, file_id, max_bytes=IMPORT_MAX_BYTES):
+        """Resolve a file_id with getFile and stream the download line by line"""
+        body = self.call("getFile", {"file_id": file_id})
+        if not body.get("ok"):
+            raise ValueError(body.get("description", "getFile failed"))
+        if body["result"].get("file_size", 0) > max_bytes:
+            raise ValueError(f"file is larger than {max_bytes // (1024 * 1024)} MB")
+        
+        self._count("requests")
+        with self.session.get(f"{self.file_url}/{body['result']['file_path']}", stream=True,
+                              timeout=DEFAULT_API_POLICY[0]) as r:
+            r.raise_for_status()
+            yield r.iter_lines(chunk_size=64 * 1024)
+    
+    def stats(self):
+        """Request and connection reuse counters"""
+        pools = self.adapter.poolmanager.pools
+        new_connections = sum(pools[key].num_connections for key in list(pools.keys()))
+        with self.lock:
+            counters = dict(self.counters)
+        counters["new_connections"] = new_connections
+        counters["reused_connections"] = max(counters["requests"] - new_connections, 0)
+        counters["pool_size"] = self.adapter._pool_maxsize
+        return counters
+    
+    def close(self):
+        self.session.close()
 
-# ================= TELEGRAM API =============================
-def send(tg, msg, reply_markup=None):
-    """Send message to user"""
-    try:
-        payload = {"chat_id": tg, "text": msg, "parse_mode": "HTML"}
-        if reply_markup:
-            payload["reply_markup"] = reply_markup
-        r = requests.post(f"{API}/sendMessage", json=payload, timeout=10)
-        return r.status_code == 200
-    except Exception as e:
-        print(f"SEND ERROR to {tg}:", e)
+def never_sent(error):
+    """True if a requests error happened before the request reached the server"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.ConnectionError):
         return False
+    # requests wraps urllib3's MaxRetryError; its reason says what failed
+    reason = getattr(error.args[0], "reason", error.args[0]) if error.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
 
-def send_with_inline_keyboard(tg, msg, buttons):
-    """Send message with inline keyboard"""
+# Shared transport for api.telegram.org (or API_BASE stand-in)
+bot_api = BotTransport(API, FILE_API)
+
+def send(tg, msg, reply_markup=None, priority=PRIORITY_REPLY):
+    """Queue message to user (returns False if the queue is full)"""
+    payload = {"chat_id": tg, "text": msg, "parse_mode": "HTML"}
+    if reply_markup:
+        payload["reply_markup"] = reply_markup
+    return outbound.submit("sendMessage", payload, priority, chat_id=tg)
+
+def send_with_inline_keyboard(tg, msg, buttons, priority=PRIORITY_REPLY):
+    """Queue message with inline keyboard"""
     keyboard = {"inline_keyboard": buttons}
-    return send(tg, msg, keyboard)
+    return send(tg, msg, keyboard, priority)
 
-def check_member(tg):
-    """Check if user is channel member (with error handling)"""
+def fetch_member(tg):
+    """Ask the Bot API whether user is channel member (with error handling)"""
     try:
-        r = requests.post(
-            f"{API}/getChatMember",
-            json={"chat_id": CHANNEL, "user_id": tg},
-            timeout=10
-        ).json()
+        api_limiter.acquire()
+        r = bot_api.call("getChatMember", {"chat_id": CHANNEL, "user_id": tg})
         
         if not r.get("ok"):
             print(f"API Error for user {tg}:", r.get("description"))
             return None  # Unknown status
         
-        status = r.get("result", {}).get("status", "left")
-        return status in ["member", "administrator", "creator"]
-    except Exception as e:
-        print(f"Network/API Error for user {tg}:", e)
-        return None  # Unknown status
+        status = r.get("result", {}).get("status", "left")
+        return status in MEMBER_STATUSES
+    except Exception as e:
+        print(f"Network/API Error for user {tg}:", e)
+        return None  # Unknown status
+
+# ================= RATE LIMITING ============================
+class TokenBucket:
+    """Thread-safe token bucket rate limiter"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Block until a token is available"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+    
+    def set_rate(self, rate, capacity):
+        """Change the refill rate and burst (tokens earned so far are kept)"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.rate = rate
+            self.capacity = capacity
+            self.tokens = min(self.tokens, capacity)
+
+# getChatMember limiter; ShardCoordinator splits API_RATE_LIMIT across live processes
+api_limiter = TokenBucket(API_RATE_LIMIT, API_BURST)
+
+# ================= OUTBOUND DISPATCH ========================
+class OutboundDispatcher:
+    """Priority send queue with global/per-chat rate limits and 429 backoff"""
+    def __init__(self, workers, rate, chat_interval, max_size):
+        self.workers = workers
+        self.chat_interval = chat_interval
+        self.max_size = max_size
+        self.limiter = TokenBucket(rate, max(1, int(rate)))
+        self.ready = []    # heap of (priority, seq, job)
+        self.delayed = []  # heap of (ready_at, seq, job)
+        self.chat_next = {}  # chat_id -> earliest next send (monotonic)
+        self.chat_pruned_at = time.monotonic()
+        self.paused_until = 0.0
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.started = False
+        self.counters = {"queued": 0, "sent": 0, "failed": 0, "retried": 0,
+                         "rate_limited": 0, "dropped": 0}
+    
+    def start(self):
+        """Start sender threads (idempotent)"""
+        with self.cond:
+            if self.started:
+                return
+            self.started = True
+        for i in range(self.workers):
+            threading.Thread(target=self._run, name=f"outbound-{i}", daemon=True).start()
+    
+    def submit(self, method, payload, priority=PRIORITY_REPLY, chat_id=None):
+        """Enqueue a Bot API call and return immediately"""
+        self.start()
+        job = {"method": method, "payload": payload, "priority": priority, "seq": next(self.seq),
+               "chat_id": chat_id, "attempts": 0, "queued_at": time.monotonic()}
+        with self.cond:
+            if len(self.ready) + len(self.delayed) >= self.max_size:
+                self.counters["dropped"] += 1
+                print(f"[OUTBOUND] Queue full, dropped {method} to {chat_id}")
+                return False
+            heapq.heappush(self.ready, (priority, job["seq"], job))
+            self.counters["queued"] += 1
+            self.cond.notify()
+        return True
+    
+    def _requeue(self, job, delay):
+        with self.cond:
+            heapq.heappush(self.delayed, (time.monotonic() + delay, next(self.seq), job))
+            self.cond.notify()
+    
+    def _next_job(self):
+        """Block until a job may be sent under the pause and per-chat limits"""
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    _, _, job = heapq.heappop(self.delayed)
+                    # Original sequence keeps per-chat order after a delay
+                    heapq.heappush(self.ready, (job["priority"], job["seq"], job))
+                
+                # Chats whose cooldown has passed need no entry
+                if now - self.chat_pruned_at >= max(self.chat_interval, 1.0):
+                    self.chat_next = {chat: at for chat, at in self.chat_next.items() if at > now}
+                    self.chat_pruned_at = now
+                
+                wake_at = self.delayed[0][0] if self.delayed else None
+                if self.paused_until > now:
+                    wake_at = self.paused_until
+                elif self.ready:
+                    _, _, job = heapq.heappop(self.ready)
+                    chat_id = job["chat_id"]
+                    if chat_id is None or self.chat_next.get(chat_id, 0) <= now:
+                        if chat_id is not None:
+                            self.chat_next[chat_id] = now + self.chat_interval
+                        return job
+                    # Chat is still cooling down, park the job until it may go
+                    heapq.heappush(self.delayed, (self.chat_next[chat_id], next(self.seq), job))
+                    continue
+                
+                self.cond.wait(None if wake_at is None else max(wake_at - now, 0.01))
+    
+    def _run(self):
+        while True:
+            job = self._next_job()
+            self.limiter.acquire()
+            self._deliver(job)
+    
+    def _deliver(self, job):
+        job["attempts"] += 1
+        retry_5xx = job["method"] not in NON_IDEMPOTENT_METHODS
+        try:
+            r = bot_api.call(job["method"], job["payload"])
+        except requests.RequestException as e:
+            if not (never_sent(e) or retry_5xx):
+                # The request may have been delivered; a retry could duplicate it
+                with self.cond:
+                    self.counters["failed"] += 1
+                print(f"SEND ERROR {job['method']} to {job['chat_id']} (not retried):", e)
+                return
+            r = {"ok": False, "error_code": None, "description": str(e)}
+        except Exception as e:
+            with self.cond:
+                self.counters["failed"] += 1
+            print(f"SEND ERROR {job['method']} to {job['chat_id']}:", e)
+            return
+        
+        if r.get("ok"):
+            with self.cond:
+                self.counters["sent"] += 1
+            SEND_SECONDS.observe(time.monotonic() - job["queued_at"], method=job["method"])
+            return
+        
+        error_code = r.get("error_code")
+        if error_code == 429:
+            # Flood control: honour retry_after for everyone, the message is kept
+            retry_after = r.get("parameters", {}).get("retry_after", 1)
+            with self.cond:
+                self.counters["rate_limited"] += 1
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            print(f"[OUTBOUND] 429 from Telegram, pausing {retry_after}s")
+            self._requeue(job, retry_after)
+            return
+        
+        # A 5xx may come after Telegram already acted on the call
+        retryable = error_code is None or (error_code >= 500 and retry_5xx)
+        if retryable and job["attempts"] < SEND_MAX_ATTEMPTS:
+            with self.cond:
+                self.counters["retried"] += 1
+            self._requeue(job, 2 ** job["attempts"])
+            return
+        
+        with self.cond:
+            self.counters["failed"] += 1
+        print(f"SEND ERROR {job['method']} to {job['chat_id']}:", r.get("description"))
+    
+    def stats(self):
+        """Queue depth by priority and delivery counters"""
+        with self.cond:
+            stats = dict(self.counters)
+            depth = {}
+            for entry in self.ready + self.delayed:
+                priority = entry[2]["priority"]
+                depth[priority] = depth.get(priority, 0) + 1
+            stats["depth"] = {str(p): depth[p] for p in sorted(depth)}
+            stats["paused_for"] = round(max(self.paused_until - time.monotonic(), 0), 2)
+        return stats
+
+outbound = OutboundDispatcher(SEND_WORKERS, SEND_RATE_LIMIT, SEND_CHAT_INTERVAL, SEND_QUEUE_SIZE)
+
+# ================= MEMBERSHIP CACHE =========================
+class MembershipCache:
+    """LRU cache of membership results with TTLs and single-flight lookups"""
+    def __init__(self, fetch, ttl, negative_ttl, max_size):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()  # tg -> (is_member, expires_at)
+        self.inflight = {}  # tg -> shared lookup
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0, "invalidations": 0}
+    
+    def _store(self, tg, is_member):
+        ttl = self.ttl if is_member else self.negative_ttl
+        self.entries[tg] = (is_member, time.monotonic() + ttl)
+        self.entries.move_to_end(tg)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.counters["evictions"] += 1
+    
+    def get(self, tg, fresh=False):
+        """Cached membership; concurrent misses for one user share a single request"""
+        owner = False
+        with self.lock:
+            if not fresh:
+                entry = self.entries.get(tg)
+                if entry and entry[1] > time.monotonic():
+                    self.entries.move_to_end(tg)
+                    self.counters["hits"] += 1
+                    return entry[0]
+            
+            lookup = self.inflight.get(tg)
+            if lookup:
+                self.counters["coalesced"] += 1
+            else:
+                lookup = {"done": threading.Event(), "result": None, "stale": False}
+                self.inflight[tg] = lookup
+                self.counters["misses"] += 1
+                owner = True
+        
+        if not owner:
+            lookup["done"].wait()
+            return lookup["result"]
+        
+        result = None
+        try:
+            result = self.fetch(tg)
+            lookup["result"] = result
+        finally:
+            with self.lock:
+                self.inflight.pop(tg, None)
+                # API errors are never cached
+                if result is not None and not lookup["stale"]:
+                    self._store(tg, result)
+            lookup["done"].set()
+        return result
+    
+    def set(self, tg, is_member):
+        """Record a known membership (e.g. from a chat_member event)"""
+        with self.lock:
+            lookup = self.inflight.get(tg)
+            if lookup:
+                lookup["stale"] = True
+            self._store(tg, is_member)
+    
+    def invalidate(self, tg):
+        """Evict a user so the next check goes to the API"""
+        with self.lock:
+            lookup = self.inflight.get(tg)
+            if lookup:
+                lookup["stale"] = True
+            if self.entries.pop(tg, None) is not None:
+                self.counters["invalidations"] += 1
+    
+    def stats(self):
+        """Hit/miss counters and rates"""
+        with self.lock:
+            stats = dict(self.counters)
+            stats["size"] = len(self.entries)
+        lookups = stats["hits"] + stats["misses"] + stats["coalesced"]
+        stats["hit_rate"] = round((stats["hits"] + stats["coalesced"]) / lookups, 4) if lookups else 0.0
+        stats["miss_rate"] = round(stats["misses"] / lookups, 4) if lookups else 0.0
+        return stats
+
+member_cache = MembershipCache(fetch_member, MEMBER_CACHE_TTL, MEMBER_CACHE_NEGATIVE_TTL, MEMBER_CACHE_SIZE)
+
+def check_member(tg, fresh=False):
+    """Check if user is channel member (cached, None on API error)"""
+    with CHECK_MEMBER_SECONDS.time(fresh="true" if fresh else "false"):
+        return member_cache.get(tg, fresh)
+
+# ================= CHECK SCHEDULER ==========================
+def check_interval(stable_checks):
+    """Seconds until next check: SCAN_TIME, backing off for stable members"""
+    return min(SCAN_MAX_INTERVAL, SCAN_TIME * SCAN_BACKOFF ** min(stable_checks, 32))
+
+class DeadlineHeap:
+    """Indexed min-heap of users keyed by a deadline (unix time)"""
+    def __init__(self):
+        self.heap = []  # (due, tg); superseded entries are skipped lazily
+        self.due_at = {}  # tg -> current deadline
+        self.cond = threading.Condition()
+    
+    def _rebuild(self):
+        self.heap = [(due, tg) for tg, due in self.due_at.items()]
+        heapq.heapify(self.heap)
+    
+    def schedule(self, tg, due):
+        """Set (or move) a user's deadline"""
+        with self.cond:
+            self.due_at[tg] = due
+            heapq.heappush(self.heap, (due, tg))
+            # Drop superseded entries once they dominate the heap
+            if len(self.heap) > 2 * len(self.due_at) + 1024:
+                self._rebuild()
+            self.cond.notify()
+    
+    def remove(self, tg):
+        """Forget a user's deadline"""
+        with self.cond:
+            self.due_at.pop(tg, None)
+    
+    def pop_due(self, limit=None):
+        """Take users whose deadline has passed (earliest first)"""
+        now = time.time()
+        users = []
+        with self.cond:
+            while self.heap and self.heap[0][0] <= now and (limit is None or len(users) < limit):
+                due, tg = heapq.heappop(self.heap)
+                if self.due_at.get(tg) == due:
+                    del self.due_at[tg]
+                    users.append(tg)
+        return users
+    
+    def next_due(self):
+        """Earliest live deadline, or None"""
+        with self.cond:
+            while self.heap and self.due_at.get(self.heap[0][1]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            return self.heap[0][0] if self.heap else None
+    
+    def wait_for_due(self, max_wait):
+        """Sleep until the earliest deadline, a new schedule, or max_wait"""
+        due = self.next_due()
+        delay = max_wait if due is None else min(max_wait, due - time.time())
+        if delay > 0:
+            with self.cond:
+                self.cond.wait(delay)
+
+class CheckScheduler(DeadlineHeap):
+    """Active users keyed by next-due membership check"""
+    def __init__(self):
+        super().__init__()
+        self.interval_of = {}  # tg -> current check interval
+        self.interval_counts = {}  # interval -> users on it, kept in step with interval_of
+    
+    def _count_interval(self, interval, delta):
+        count = self.interval_counts.get(interval, 0) + delta
+        if count:
+            self.interval_counts[interval] = count
+        else:
+            self.interval_counts.pop(interval, None)
+    
+    def load(self):
+        """Rebuild the schedule from user_states for the shards this process owns"""
+        owned = sorted(shards.owned)
+        rows = []
+        if owned:
+            with db_pool.reader() as db:
+                rows = db.execute(f"""
+                    SELECT tg, next_check, stable_checks FROM user_states
+                    WHERE status='active' AND tg % ? IN ({",".join("?" * len(owned))})
+                """, (shards.count, *owned)).fetchall()
+        now = time.time()
+        with self.cond:
+            self.due_at = {row['tg']: row['next_check'] or now for row in rows}
+            self.interval_of = {row['tg']: check_interval(row['stable_checks'] or 0) for row in rows}
+            self.interval_counts = {}
+            for interval in self.interval_of.values():
+                self._count_interval(interval, 1)
+            self._rebuild()
+            self.cond.notify()
+    
+    def schedule(self, tg, due, interval):
+        """(Re)schedule a user's next check; other shards' owners are nudged"""
+        if not shards.owns(tg):
+            # Strikes and joins must not wait for the owner's SCHEDULE_RELOAD
+            with db_pool.writer() as db:
+                db.execute("INSERT OR REPLACE INTO schedule_nudges(tg, due, interval) VALUES(?,?,?)",
+                           (tg, due, interval))
+                db.commit()
+            return
+        with self.cond:
+            previous = self.interval_of.get(tg)
+            if previous != interval:
+                if previous is not None:
+                    self._count_interval(previous, -1)
+                self._count_interval(interval, 1)
+                self.interval_of[tg] = interval
+        super().schedule(tg, due)
+    
+    def take_nudges(self):
+        """Schedule users that other processes nudged into our shards; returns how many"""
+        owned = sorted(shards.owned)
+        if not owned:
+            return 0
+        with db_pool.reader() as db:
+            rows = db.execute(f"""
+                SELECT tg, due, interval FROM schedule_nudges
+                WHERE tg % ? IN ({",".join("?" * len(owned))})
+            """, (shards.count, *owned)).fetchall()
+        if not rows:
+            return 0
+        with db_pool.writer() as db:
+            # Only drop nudges that were not replaced in the meantime
+            db.executemany("DELETE FROM schedule_nudges WHERE tg=? AND due=?",
+                           [(row['tg'], row['due']) for row in rows])
+            db.commit()
+        for row in rows:
+            self.schedule(row['tg'], row['due'], row['interval'])
+        return len(rows)
+    
+    def remove(self, tg):
+        """Stop checking a user (suspended / deleted)"""
+        with self.cond:
+            previous = self.interval_of.pop(tg, None)
+            if previous is not None:
+                self._count_interval(previous, -1)
+        super().remove(tg)
+    
+    def stats(self, detail=False):
+        """Scheduled users and the distribution of their check intervals.
+        
+        Cheap by default; detail=True also counts overdue users, which walks
+        a copy of the whole schedule.
+        """
+        due = self.next_due()
+        now = time.time()
+        with self.cond:
+            stats = {
+                "scheduled": len(self.due_at),
+                "heap_entries": len(self.heap),
+                "intervals": {f"{k:g}s": self.interval_counts[k] for k in sorted(self.interval_counts)}
+            }
+            dues = list(self.due_at.values()) if detail else None
+        stats["lag_seconds"] = round(max(0.0, now - due), 1) if due else 0.0
+        if detail:
+            stats["overdue"] = sum(1 for at in dues if at <= now)
+        return stats
+
+scheduler = CheckScheduler()
+
+# ================= SUSPENSION EXPIRY ========================
+class ExpiryEngine(DeadlineHeap):
+    """Suspended users keyed by suspended_until; deletes them when it passes"""
+    def __init__(self, batch_size):
+        super().__init__()
+        self.batch_size = batch_size
+        self.counters = {"expired": 0, "deleted": 0, "rejoined": 0, "retried": 0}
+    
+    def load(self):
+        """Rebuild deadlines from suspended (or interrupted 'deleted') user_states rows"""
+        with db_pool.reader() as db:
+            rows = db.execute("""
+                SELECT tg, suspended_until FROM user_states 
+                WHERE status IN ('suspended','deleted') AND suspended_until IS NOT NULL
+            """).fetchall()
+        with self.cond:
+            self.due_at = {row['tg']: parse_timestamp(row['suspended_until']).timestamp() for row in rows}
+            self._rebuild()
+            self.cond.notify()
+    
+    def run(self):
+        """Sleep until the next deadline, then expire due users in batches"""
+        print(f"⏳ Suspension expiry engine started (batches of {self.batch_size})")
+        last_load = 0
+        while True:
+            try:
+                leader.wait_until_leader()
+                
+                if time.monotonic() - last_load >= SCHEDULE_RELOAD:
+                    self.load()
+                    last_load = time.monotonic()
+                
+                batch = self.pop_due(self.batch_size)
+                if not batch:
+                    self.wait_for_due(SCHEDULE_RELOAD)
+                    continue
+                
+                deleted, rejoined, unknown = expire_suspensions(batch)
+                
+                # Membership unknown (API error): try again shortly
+                for tg in unknown:
+                    self.schedule(tg, time.time() + SCAN_TIME)
+                
+                with self.cond:
+                    self.counters["expired"] += len(batch)
+                    self.counters["deleted"] += len(deleted)
+                    self.counters["rejoined"] += len(rejoined)
+                    self.counters["retried"] += len(unknown)
+                
+                for tg in deleted:
+                    send_status_notice(tg, 'deleted', -1)
+                    
+            except Exception as e:
+                print("Expiry engine error:", e)
+                time.sleep(5)
+    
+    def stats(self):
+        """Pending deadlines and expiry counters"""
+        due = self.next_due()
+        with self.cond:
+            stats = dict(self.counters)
+            stats["pending"] = len(self.due_at)
+        stats["next_deadline_in"] = round(due - time.time(), 1) if due else None
+        return stats
+
+expiry = ExpiryEngine(EXPIRY_BATCH_SIZE)
+
+def reschedule_user(tg, stable=False):
+    """Check a user often again after a join/leave, or back off after another member check (persisted)"""
+    with db_pool.writer() as db:
+        cur = db.cursor()
+        stable_checks = 0
+        if stable:
+            row = cur.execute("SELECT stable_checks FROM user_states WHERE tg=?", (tg,)).fetchone()
+            stable_checks = (row['stable_checks'] or 0) + 1 if row else 0
+        interval = check_interval(stable_checks)
+        next_check = time.time() + interval
+        cur.execute("UPDATE user_states SET next_check=?, stable_checks=? WHERE tg=?", (next_check, stable_checks, tg))
+        db.commit()
+        scheduler.schedule(tg, next_check, interval)
+
+# ================= ENHANCED MONITOR =========================
+sweep_executor = ThreadPoolExecutor(max_workers=SWEEP_WORKERS, thread_name_prefix="sweep")
+
+# Last completed sweep (reported on /health)
+sweep_stats = {
+    "users": 0,
+    "checked": 0,
+    "api_errors": 0,
+    "duration": 0.0,
+    "checks_per_sec": 0.0,
+    "finished": None
+}
+
+def send_status_notice(tg, kind, strikes):
+    """Send the deleted / suspended / warning_N notification"""
+    NOTIFICATIONS_SENT.inc(kind=kind)
+    if kind == 'deleted':
+        buttons = [[
+            {"text": "📢 Join Channel", "url": f"https://t.me/{CHANNEL.replace('@', '')}"},
+            {"text": "🔓 Restore Access", "callback_data": "restore_access"}
+        ]]
+        send_with_inline_keyboard(tg,
+            f"🚫 <b>ACCESS PERMANENTLY REVOKED</b>\n\n"
+            f"All your IDs have been deleted.\n"
+            f"Reason: Left {CHANNEL}\n\n"
+            f"<i>Rejoin and click Restore Access</i>",
+            buttons,
+            PRIORITY_WARNING
+        )
+        print(f"[DELETE] User {tg} permanently removed")
+    
+    elif kind == 'suspended':
+        remaining_time = SUSPEND_DURATION
+        hours = remaining_time // 3600
+        minutes = (remaining_time % 3600) // 60
+        
+        buttons = [[
+            {"text": "📢 Rejoin Now", "url": f"https://t.me/{CHANNEL.replace('@', '')}"},
+            {"text": "🔄 Check Status", "callback_data": "check_status"}
+        ]]
+        send_with_inline_keyboard(tg,
+            f"⏸️ <b>ACCESS TEMPORARILY SUSPENDED</b>\n\n"
+            f"You left <code>{CHANNEL}</code>\n"
+            f"⚠️ Final Warning: {strikes}/{MAX_STRIKES}\n"
+            f"⏳ IDs will be deleted in {hours}h {minutes}m\n\n"
+            f"<i>Rejoin now to restore all IDs</i>",
+            buttons,
+            PRIORITY_WARNING
+        )
+        print(f"[SUSPEND] User {tg} suspended ({strikes} strikes)")
+    
+    else:
+        buttons = [[
+            {"text": "📢 Stay in Channel", "url": f"https://t.me/{CHANNEL.replace('@', '')}"},
+            {"text": "📊 Check Status", "callback_data": "check_status"}
+        ]]
+        send_with_inline_keyboard(tg,
+            f"⚠️ <b>WARNING: {strikes}/{MAX_STRIKES}</b>\n\n"
+            f"Leaving {CHANNEL} detected.\n"
+            f"Next violation will suspend access.\n\n"
+            f"<i>Stay in channel to avoid suspension</i>",
+            buttons,
+            PRIORITY_WARNING
+        )
+        print(f"[WARNING] User {tg}: {strikes}/{MAX_STRIKES} strikes")
+
+def process_member_result(tg, is_member):
+    """Apply one membership result through the strike system"""
+    # CRITICAL FIX #4: Update last_check even on API error
+    if is_member is None:
+        print(f"⚠️ API Error for {tg}, updating last_check only")
+        # Update last_check but no strikes
+        with db_pool.writer() as db:
+            cur = db.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            cur.execute("UPDATE user_states SET last_check=? WHERE tg=?", 
+                      (datetime.now(), tg))
+            db.commit()
+            return
+    
+    # Status before this check, to detect the transition to suspended
+    previous_status = get_user_status(tg)
+    
+    # Update strike count based on membership
+    strikes, new_status = update_strike(tg, is_member)
+    
+    if new_status == 'active':
+        # Same rule as apply_member_results(): members still active back off
+        reschedule_user(tg, stable=is_member and previous_status == 'active')
+    elif new_status in ('suspended', 'deleted'):
+        scheduler.remove(tg)
+    
+    # Handle status changes with notifications (each sent only once)
+    if strikes == -1:
+        if should_send_notification(tg, 'deleted'):
+            send_status_notice(tg, 'deleted', strikes)
+    
+    elif new_status == 'suspended' and previous_status != 'suspended':
+        if should_send_notification(tg, 'suspended'):
+            send_status_notice(tg, 'suspended', strikes)
+    
+    elif strikes > 0 and strikes < MAX_STRIKES:
+        # One warning per strike level
+        if should_send_notification(tg, f'warning_{strikes}'):
+            send_status_notice(tg, f'warning_{strikes}', strikes)
+
+def apply_member_results(results):
+    """Apply a chunk of (tg, is_member) results in one transaction, then notify.
+    
+    Same strike/suspend semantics as update_strike() + should_send_notification(),
+    but with one SELECT, a few executemany() calls and a single commit per chunk.
+    """
+    now = datetime.now()
+    retry_at = time.time() + SCAN_TIME
+    notices = []
+    schedule = []  # (tg, next_check, interval), next_check None = unschedule
+    with db_pool.writer() as db:
+        cur = db.cursor()
+        
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            
+            tgs = [tg for tg, _ in results]
+            cur.execute(f"""
+                SELECT tg, strike_count, status, suspended_until, last_notified_status, stable_checks
+                FROM user_states WHERE tg IN ({",".join("?" * len(tgs))})
+            """, tgs)
+            states = {row['tg']: row for row in cur.fetchall()}
+            
+            checked, created, resets, restores, strikes, suspends, notified, scheduled = [], [], [], [], [], [], [], []
+            for tg, is_member in results:
+                state = states.get(tg)
+                
+                if not state:
+                    if is_member is not None:
+                        created.append((tg, 'member' if is_member else 'left', now, retry_at))
+                        schedule.append((tg, retry_at, SCAN_TIME))
+                    continue
+                
+                # CRITICAL FIX #4: Update last_check even on API error
+                checked.append((now, tg))
+                stable_checks = state['stable_checks'] or 0
+                if is_member is None:
+                    # Retry soon without touching the stability streak
+                    scheduled.append((retry_at, stable_checks, tg))
+                    schedule.append((tg, retry_at, SCAN_TIME))
+                    continue
+                
+                if state['status'] == 'deleted':
+                    schedule.append((tg, None, None))
+                    continue
+                
+                if is_member and state['status'] == 'suspended':
+                    # Rejoined while suspended: restore like restore_user(), IDs included
+                    restores.append((retry_at, tg))
+                    schedule.append((tg, retry_at, SCAN_TIME))
+                    continue
+                
+                if is_member:
+                    # Each consecutive member check backs the interval off further
+                    interval = check_interval(stable_checks + 1)
+                    resets.append((tg,))
+                    scheduled.append((time.time() + interval, stable_checks + 1, tg))
+                    schedule.append((tg, scheduled[-1][0], interval))
+                    continue
+                
+                new_strikes = state['strike_count'] + 1
+                kind = None
+                if new_strikes >= MAX_STRIKES and state['status'] != 'suspended':
+                    suspends.append((new_strikes, now + timedelta(seconds=SUSPEND_DURATION), tg))
+                    schedule.append((tg, None, None))
+                    kind = 'suspended'
+                else:
+                    strikes.append((new_strikes, tg))
+                    if state['status'] == 'active':
+                        scheduled.append((retry_at, 0, tg))
+                        schedule.append((tg, retry_at, SCAN_TIME))
+                    else:
+                        schedule.append((tg, None, None))
+                    if new_strikes < MAX_STRIKES:
+                        kind = f'warning_{new_strikes}'
+                
+                # Same rule as should_send_notification(): never repeat the last notice
+                if kind and state['last_notified_status'] != kind:
+                    notified.append((kind, tg))
+                    notices.append((tg, kind, new_strikes))
+                elif kind:
+                    NOTIFICATIONS_SUPPRESSED.inc(kind=kind)
+            
+            cur.executemany("""
+                INSERT OR IGNORE INTO user_states (tg, last_member_status, last_check, next_check)
+                VALUES(?,?,?,?)
+            """, created)
+            cur.executemany("UPDATE user_states SET last_check=? WHERE tg=?", checked)
+            cur.executemany("""
+                UPDATE user_states 
+                SET strike_count=0, status='active', last_member_status='member'
+                WHERE tg=?
+            """, resets)
+            cur.executemany("""
+                UPDATE user_states 
+                SET strike_count=0, status='active', suspended_until=NULL, last_member_status='member',
+                    last_notified_status='restored', next_check=?, stable_checks=0
+                WHERE tg=?
+            """, restores)
+            cur.executemany("UPDATE users SET status='active' WHERE tg=? AND status='suspended'",
+                            [(tg,) for _, tg in restores])
+            cur.executemany("""
+                UPDATE user_states 
+                SET strike_count=?, last_member_status='left'
+                WHERE tg=?
+            """, strikes)
+            cur.executemany("""
+                UPDATE user_states 
+                SET strike_count=?, status='suspended', suspended_until=?, last_member_status='left'
+                WHERE tg=?
+            """, suspends)
+            cur.executemany("""
+                UPDATE user_states 
+                SET last_notified_status=?, notifications_sent=notifications_sent+1
+                WHERE tg=?
+            """, notified)
+            cur.executemany("UPDATE user_states SET next_check=?, stable_checks=? WHERE tg=?", scheduled)
+            
+            db.commit()
+            
+        except Exception as e:
+            db.rollback()
+            print(f"Error applying sweep batch of {len(results)} users: {e}")
+            return
+        
+        STRIKES.inc(len(strikes) + len(suspends))
+        SUSPENSIONS.inc(len(suspends))
+        RESTORES.inc(len(restores))
+        if restores:
+            id_counts.invalidate(*(tg for _, tg in restores))
+        known_users.add(*(row[0] for row in created))
+        
+        for tg, next_check, interval in schedule:
+            if next_check is None:
+                scheduler.remove(tg)
+            else:
+                scheduler.schedule(tg, next_check, interval)
+        
+        # Suspension deadlines go to the expiry engine
+        for _, suspend_time, tg in suspends:
+            expiry.schedule(tg, suspend_time.timestamp())
+        for (tg,) in resets:
+            expiry.remove(tg)
+        for _, tg in restores:
+            expiry.remove(tg)
+        
+        for tg, kind, strike_count in notices:
+            send_status_notice(tg, kind, strike_count)
+
+def run_sweep(users):
+    """Check users on the worker pool, apply results in batched transactions"""
+    started = time.monotonic()
+    submitted = checked = api_errors = 0
+    pending = {}
+    batch = []
+    users = iter(users)
+    
+    while True:
+        # Keep a bounded window of checks in flight
+        while len(pending) < SWEEP_WORKERS * 4:
+            tg = next(users, None)
+            if tg is None:
+                break
+            pending[sweep_executor.submit(check_member, tg)] = tg
+            submitted += 1
+        
+        if not pending:
+            break
+        
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            tg = pending.pop(future)
+            try:
+                is_member = future.result()
+            except Exception as e:
+                print(f"Error checking user {tg}:", e)
+                is_member = None
+            checked += 1
+            if is_member is None:
+                api_errors += 1
+            shards.record(tg, is_member is None)
+            batch.append((tg, is_member))
+        
+        # SQLite writes stay on the monitor thread, one commit per chunk
+        if len(batch) >= SWEEP_BATCH_SIZE:
+            apply_member_results(batch)
+            batch = []
+    
+    if batch:
+        apply_member_results(batch)
+    
+    duration = time.monotonic() - started
+    SWEEP_SECONDS.observe(duration)
+    sweep_stats.update({
+        "users": submitted,
+        "checked": checked,
+        "api_errors": api_errors,
+        "duration": round(duration, 3),
+        "checks_per_sec": round(checked / duration, 2) if duration > 0 else 0.0,
+        "finished": datetime.now().isoformat()
+    })
+    return sweep_stats
 
-# ================= ENHANCED MONITOR =========================
 def monitor():
     """Enhanced anti-leave monitor with thread safety"""
     print("🛡️ ENTERPRISE ANTI-LEAVE MONITOR STARTED")
     print(f"📊 Config: {MAX_STRIKES} strikes | {SUSPEND_DURATION//3600} hour suspension")
     print(f"🔒 Double-check delete: {DOUBLE_CHECK_DELETE}")
+    print(f"⚡ Sweep: {SWEEP_WORKERS} workers | {API_RATE_LIMIT:g} checks/s limit")
+    print(f"⏱️ Check interval: {SCAN_TIME}s → {SCAN_MAX_INTERVAL}s for stable members")
     
+    last_load = 0
     while True:
         try:
-            # Get ONLY active users (not suspended ones)
-            active_users = get_active_users()
-            print(f"👥 Monitoring {len(active_users)} active users")
+            shards.wait_until_owner()
             
-            for tg in active_users:
-                try:
-                    # Check membership with error handling
-                    is_member = check_member(tg)
-                    
-                    # CRITICAL FIX #4: Update last_check even on API error
-                    if is_member is None:
-                        print(f"⚠️ API Error for {tg}, updating last_check only")
-                        # Update last_check but no strikes
-                        db = get_db()
-                        cur = db.cursor()
-                        cur.execute("BEGIN IMMEDIATE")
-                        cur.execute("UPDATE user_states SET last_check=? WHERE tg=?", 
-                                  (datetime.now(), tg))
-                        db.commit()
-                        continue
-                    
-                    # Update strike count based on membership
-                    strikes, new_status = update_strike(tg, is_member)
-                    current_status = get_user_status(tg)
-                    
-                    # Handle status changes with notifications
-                    if strikes == -1:
-                        # User deleted - send notification only once
-                        if should_send_notification(tg, 'deleted'):
-                            buttons = [[
-                                {"text": "📢 Join Channel", "url": f"https://t.me/{CHANNEL.replace('@', '')}"},
-                                {"text": "🔓 Restore Access", "callback_data": "restore_access"}
-                            ]]
-                            send_with_inline_keyboard(tg,
-                                f"🚫 <b>ACCESS PERMANENTLY REVOKED</b>\n\n"
-                                f"All your IDs have been deleted.\n"
-                                f"Reason: Left {CHANNEL}\n\n"
-                                f"<i>Rejoin and click Restore Access</i>",
-                                buttons
-                            )
-                            print(f"[DELETE] User {tg} permanently removed")
-                    
-                    elif new_status == 'suspended' and current_status != 'suspended':
-                        # Status changed to suspended - send notification only once
-                        if should_send_notification(tg, 'suspended'):
-                            remaining_time = SUSPEND_DURATION
-                            hours = remaining_time // 3600
-                            minutes = (remaining_time % 3600) // 60
-                            
-                            buttons = [[
-                                {"text": "📢 Rejoin Now", "url": f"https://t.me/{CHANNEL.replace('@', '')}"},
-                                {"text": "🔄 Check Status", "callback_data": "check_status"}
-                            ]]
-                            send_with_inline_keyboard(tg,
-                                f"⏸️ <b>ACCESS TEMPORARILY SUSPENDED</b>\n\n"
-                                f"You left <code>{CHANNEL}</code>\n"
-                                f"⚠️ Final Warning: {strikes}/{MAX_STRIKES}\n"
-                                f"⏳ IDs will be deleted in {hours}h {minutes}m\n\n"
-                                f"<i>Rejoin now to restore all IDs</i>",
-                                buttons
-                            )
-                            print(f"[SUSPEND] User {tg} suspended ({strikes} strikes)")
-                    
-                    elif strikes > 0 and strikes < MAX_STRIKES:
-                        # Warning strikes - send notification only once per strike level
-                        if should_send_notification(tg, f'warning_{strikes}'):
-                            buttons = [[
-                                {"text": "📢 Stay in Channel", "url": f"https://t.me/{CHANNEL.replace('@', '')}"},
-                                {"text": "📊 Check Status", "callback_data": "check_status"}
-                            ]]
-                            send_with_inline_keyboard(tg,
-                                f"⚠️ <b>WARNING: {strikes}/{MAX_STRIKES}</b>\n\n"
-                                f"Leaving {CHANNEL} detected.\n"
-                                f"Next violation will suspend access.\n\n"
-                                f"<i>Stay in channel to avoid suspension</i>",
-                                buttons
-                            )
-                            print(f"[WARNING] User {tg}: {strikes}/{MAX_STRIKES} strikes")
-                    
-                except Exception as e:
-                    print(f"Error processing user {tg}:", e)
-                    continue
+            # Pick up users changed outside this process, or a new shard assignment
+            if shards.changed.is_set() or time.monotonic() - last_load >= SCHEDULE_RELOAD:
+                shards.changed.clear()
+                scheduler.load()
+                last_load = time.monotonic()
+            scheduler.take_nudges()
+            
+            # Only due users (active ones) in shards we still own
+            due_users = [tg for tg in scheduler.pop_due() if shards.owns(tg)]
+            if not due_users:
+                scheduler.wait_for_due(min(SCAN_TIME, SCHEDULE_NUDGE_POLL))
+                continue
             
-            print(f"✅ Scan completed, next in {SCAN_TIME}s")
-            time.sleep(SCAN_TIME)
+            print(f"👥 Checking {len(due_users)} due users")
+            with profiler.capture("monitor"):
+                stats = run_sweep(due_users)
+            print(f"✅ Scan completed: {stats['checked']} checks in {stats['duration']:.1f}s "
+                  f"({stats['checks_per_sec']:.1f} checks/s)")
             
         except Exception as e:
             print("Monitor loop error:", e)
             time.sleep(30)
 
 # ================= MESSAGE HANDLER ==========================
+def is_our_channel(chat):
+    """Check whether a chat object is the monitored CHANNEL"""
+    if str(chat.get("id")) == CHANNEL:
+        return True
+    username = chat.get("username")
+    return bool(username) and f"@{username}".lower() == CHANNEL.lower()
+
+def handle_chat_member(event):
+    """Drive strikes and restores from channel join/leave events"""
+    if not is_our_channel(event.get("chat", {})):
+        return
+    
+    member = event.get("new_chat_member", {})
+    user = member.get("user", {})
+    tg = user.get("id")
+    if not tg or user.get("is_bot"):
+        return
+    
+    # Only users who started the bot are tracked
+    state = get_user_state(tg)
+    if not state or state['status'] == 'deleted':
+        return
+    
+    status = member.get("status")
+    is_member = status in MEMBER_STATUSES or (status == "restricted" and member.get("is_member"))
+    member_cache.set(tg, bool(is_member))
+    
+    if is_member:
+        print(f"[EVENT] User {tg} joined {CHANNEL}")
+        if state['status'] == 'suspended':
+            restore_user(tg)
+            user_count = count_user_ids(tg)
+            
+            buttons = [[
+                {"text": "📊 Check Status", "callback_data": "check_status"},
+                {"text": "➕ Add ID", "callback_data": "add_id"}
+            ]]
+            send_with_inline_keyboard(tg,
+                f"✅ <b>ACCESS RESTORED</b>\n\n"
+                f"Welcome back to {CHANNEL}!\n"
+                f"All your IDs ({user_count}) have been restored.\n"
+                f"Strikes reset to 0.\n\n"
+                f"<i>Protection is now active</i>",
+                buttons,
+                PRIORITY_WARNING
+            )
+        else:
+            update_strike(tg, True)
+            reschedule_user(tg)
+    else:
+        # A strike now; struck users are re-checked every SCAN_TIME
+        print(f"[EVENT] User {tg} left {CHANNEL} ({status})")
+        if state['status'] == 'active':
+            process_member_result(tg, False)
+
+def handle_document_import(tg, document):
+    """Import an uploaded text file of IDs and reply with one summary"""
+    ensure_user_state(tg)
+    
+    if not check_member(tg) or get_user_status(tg) == 'suspended':
+        buttons = [[
+            {"text": "📢 Join Channel", "url": f"https://t.me/{CHANNEL.replace('@', '')}"},
+            {"text": "🔄 Restore Access", "callback_data": "restore_access"}
+        ]]
+        send_with_inline_keyboard(tg,
+            f"❌ <b>IMPORT DENIED</b>\n\n"
+            f"Only active members of {CHANNEL} can import IDs.",
+            buttons
+        )
+        return
+    
+    if document.get("file_size", 0) > IMPORT_MAX_BYTES:
+        send(tg, f"❌ File too large. Max {IMPORT_MAX_BYTES // (1024 * 1024)} MB.")
+        return
+    
+    try:
+        with bot_api.open_file(document["file_id"]) as lines:
+            summary = import_ids(tg, lines)
+    except (ValueError, requests.RequestException) as e:
+        print(f"Error downloading import file for {tg}: {e}")
+        send(tg, "❌ Could not download the file. Please try again.")
+        return
+    
+    if "error" in summary and not summary["inserted"]:
+        send(tg, "❌ Error importing IDs. Please try again.")
+        return
+    
+    buttons = [[{"text": "📊 View Stats", "callback_data": "check_status"}]]
+    send_with_inline_keyboard(tg,
+        f"📥 <b>IMPORT COMPLETE</b>\n\n"
+        f"✅ Added: {summary['inserted']}\n"
+        f"♻️ Already saved: {summary['existing']}\n"
+        f"🔁 Duplicates in file: {summary['duplicates']}\n"
+        f"⚠️ Invalid: {summary['invalid']}\n"
+        + (f"✂️ Stopped early (max {IMPORT_MAX_IDS} unique IDs / {IMPORT_MAX_LINES} lines)\n" if summary["truncated"] else "")
+        + ("❗ Import interrupted, retry to finish\n" if "error" in summary else "")
+        + f"👤 Your Total IDs: {count_user_ids(tg)}\n"
+        f"⏱️ Took {summary['seconds']}s",
+        buttons
+    )
+
 def handler(update):
     """Handle Telegram updates"""
+    # Handle channel membership changes (bot must be channel admin)
+    if "chat_member" in update:
+        handle_chat_member(update["chat_member"])
+        return
+    
     # Handle callback queries
     if "callback_query" in update:
         callback = update["callback_query"]
@@ -595,14 +2646,8 @@ def handler(update):
         
         if data == "check_status":
             is_member = check_member(tg)
-            db = get_db()
-            cur = db.cursor()
-            
-            cur.execute("SELECT COUNT(*) as count FROM users WHERE tg=? AND status='active'", (tg,))
-            user_ids = cur.fetchone()['count']
-            
-            cur.execute("SELECT strike_count, status FROM user_states WHERE tg=?", (tg,))
-            strike_result = cur.fetchone()
+            user_ids = count_user_ids(tg)
+            strike_result = get_user_state(tg)
             strikes = strike_result['strike_count'] if strike_result else 0
             user_status = strike_result['status'] if strike_result else 'active'
             
@@ -626,10 +2671,7 @@ def handler(update):
         
         elif data == "view_stats":
             total, active_users, suspended_users, today, deleted_count = get_stats()
-            db = get_db()
-            cur = db.cursor()
-            cur.execute("SELECT COUNT(*) as count FROM users WHERE tg=? AND status='active'", (tg,))
-            user_count = cur.fetchone()['count']
+            user_count = count_user_ids(tg)
             
             send(tg,
                 f"📈 <b>SYSTEM STATISTICS</b>\n\n"
@@ -655,13 +2697,10 @@ def handler(update):
             )
         
         elif data == "restore_access":
-            is_member = check_member(tg)
+            is_member = check_member(tg, fresh=True)
             if is_member:
                 restore_user(tg)
-                db = get_db()
-                cur = db.cursor()
-                cur.execute("SELECT COUNT(*) as count FROM users WHERE tg=? AND status='active'", (tg,))
-                user_count = cur.fetchone()['count']
+                user_count = count_user_ids(tg)
                 
                 buttons = [[
                     {"text": "📊 Check Status", "callback_data": "check_status"},
@@ -687,8 +2726,7 @@ def handler(update):
                 )
         
         # Answer callback query
-        requests.post(f"{API}/answerCallbackQuery", 
-                     json={"callback_query_id": callback["id"]})
+        outbound.submit("answerCallbackQuery", {"callback_query_id": callback["id"]}, PRIORITY_CALLBACK)
         return
     
     # Handle regular messages
@@ -699,6 +2737,11 @@ def handler(update):
     tg = msg["from"]["id"]
     txt = msg.get("text", "")
     
+    # BULK IMPORT (uploaded ID list)
+    if "document" in msg:
+        handle_document_import(tg, msg["document"])
+        return
+    
     if not txt:
         return
     
@@ -732,10 +2775,7 @@ def handler(update):
         if user_status == 'suspended':
             restore_user(tg)
         
-        db = get_db()
-        cur = db.cursor()
-        cur.execute("SELECT COUNT(*) as count FROM users WHERE tg=? AND status='active'", (tg,))
-        user_count = cur.fetchone()['count']
+        user_count = count_user_ids(tg)
         
         buttons = [[
             {"text": "📊 Check Status", "callback_data": "check_status"},
@@ -775,10 +2815,7 @@ def handler(update):
     # STATS command
     if txt == "/stats":
         total, active_users, suspended_users, today, deleted_count = get_stats()
-        db = get_db()
-        cur = db.cursor()
-        cur.execute("SELECT COUNT(*) as count FROM users WHERE tg=? AND status='active'", (tg,))
-        user_count = cur.fetchone()['count']
+        user_count = count_user_ids(tg)
         
         buttons = [[{"text": "📄 Public Data", "url": f"http://localhost:{PORT}/"}]]
         send_with_inline_keyboard(tg,
@@ -805,10 +2842,7 @@ def handler(update):
         user_status = get_user_status(tg)
         
         if not is_member or user_status == 'suspended':
-            db = get_db()
-            cur = db.cursor()
-            cur.execute("SELECT strike_count FROM user_states WHERE tg=?", (tg,))
-            strike_result = cur.fetchone()
+            strike_result = get_user_state(tg)
             strike_count = strike_result['strike_count'] if strike_result else 0
             
             buttons = [[
@@ -831,10 +2865,7 @@ def handler(update):
         
         # Add ID
         if add_id(tg, txt):
-            db = get_db()
-            cur = db.cursor()
-            cur.execute("SELECT COUNT(*) as count FROM users WHERE tg=? AND status='active'", (tg,))
-            user_count = cur.fetchone()['count']
+            user_count = count_user_ids(tg)
             
             buttons = [[
                 {"text": "➕ Add Another", "callback_data": "add_id"},
@@ -852,45 +2883,647 @@ def handler(update):
         else:
             send(tg, "❌ Error saving ID. Please try again.")
 
+# ================= UPDATE DISPATCH ==========================
+def update_type(update):
+    """Kind of update (message, callback_query, chat_member, ...)"""
+    return next((kind for kind in update if kind != "update_id"), "unknown")
+
+def update_user_id(update):
+    """User an update belongs to (0 if none)"""
+    for kind in ("message", "callback_query"):
+        if kind in update:
+            return update[kind].get("from", {}).get("id", 0)
+    if "chat_member" in update:
+        return update["chat_member"].get("new_chat_member", {}).get("user", {}).get("id", 0)
+    return 0
+
+def percentiles(samples):
+    """p50/p95/max summary of a latency window (milliseconds)"""
+    if not samples:
+        return {"p50": 0.0, "p95": 0.0, "max": 0.0}
+    ordered = sorted(samples)
+    pick = lambda q: round(ordered[min(int(len(ordered) * q), len(ordered) - 1)], 2)
+    return {"p50": pick(0.5), "p95": pick(0.95), "max": round(ordered[-1], 2)}
+
+class UpdateDispatcher:
+    """Fan updates out to workers partitioned by user, keeping per-user order"""
+    def __init__(self, workers, queue_size):
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.lock = threading.Lock()
+        self.started = False
+        self.counters = {"received": 0, "handled": 0, "errors": 0}
+        self.wait_ms = deque(maxlen=1000)
+        self.latency_ms = deque(maxlen=1000)
+    
+    def start(self):
+        """Start worker threads (idempotent)"""
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        for i, updates in enumerate(self.queues):
+            threading.Thread(target=self._run, args=(updates,), name=f"updates-{i}", daemon=True).start()
+    
+    def submit(self, update, block=True):
+        """Queue an update on its user's partition (False if full and not blocking)"""
+        self.start()
+        partition = self.queues[update_user_id(update) % len(self.queues)]
+        try:
+            partition.put((time.monotonic(), update), block=block)
+        except queue.Full:
+            return False
+        with self.lock:
+            self.counters["received"] += 1
+        return True
+    
+    def _run(self, updates):
+        while True:
+            received, update = updates.get()
+            started = time.monotonic()
+            kind = update_type(update)
+            slow_log.begin()
+            try:
+                with HANDLER_SECONDS.time(type=kind), profiler.capture("poller"):
+                    handler(update)
+                outcome = "handled"
+            except Exception as e:
+                print("Handler Error:", e)
+                outcome = "errors"
+            finished = time.monotonic()
+            trace = slow_log.end()
+            ms = (finished - started) * 1000
+            if slow_log.is_slow("handler", ms):
+                slow_log.record("handler", kind, ms, user=update_user_id(update), outcome=outcome,
+                                queue_wait_ms=(started - received) * 1000,
+                                other_ms=ms - trace["sql_ms"] - trace["api_ms"], **trace)
+            with self.lock:
+                self.counters[outcome] += 1
+                self.wait_ms.append((started - received) * 1000)
+                self.latency_ms.append((finished - received) * 1000)
+    
+    def stats(self):
+        """Queue depths and end-to-end latency (receipt to handler done)"""
+        with self.lock:
+            stats = dict(self.counters)
+            stats["queue_wait_ms"] = percentiles(self.wait_ms)
+            stats["latency_ms"] = percentiles(self.latency_ms)
+        depths = [updates.qsize() for updates in self.queues]
+        stats["queue_depth"] = sum(depths)
+        stats["max_partition_depth"] = max(depths)
+        return stats
+
+update_dispatch = UpdateDispatcher(UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+
+# ================= PROFILING ================================
+class Profiler:
+    """On-demand cProfile capture or stack sampling per target.
+    
+    monitor  the monitor loop (cprofile) plus its sweep workers (sample)
+    poller   the poller loop and the update workers running handler()
+    http     Flask request handling
+    
+    cprofile mode profiles code inside profiler.capture(target) blocks;
+    sample mode snapshots the target threads' stacks every interval and
+    writes collapsed stacks (flamegraph.pl / speedscope input).
+    """
+    TARGETS = ("monitor", "poller", "http")
+    MODES = ("cprofile", "sample")
+    
+    def __init__(self, directory):
+        self.directory = directory
+        self.sessions = {}  # target -> active session
+        self.http_threads = set()  # idents of threads inside a Flask request
+        self.lock = threading.Lock()
+    
+    def start(self, target, mode="cprofile", interval=0.005):
+        if target not in self.TARGETS or mode not in self.MODES:
+            raise ValueError(f"target must be one of {self.TARGETS}, mode one of {self.MODES}")
+        session = {"mode": mode, "started": time.time(), "stats": None, "captures": 0,
+                   "stacks": {}, "samples": 0, "stop": threading.Event()}
+        with self.lock:
+            if target in self.sessions:
+                raise ValueError(f"{target} is already being profiled")
+            self.sessions[target] = session
+        if mode == "sample":
+            session["thread"] = threading.Thread(target=self._sample, args=(target, session, interval),
+                                                 name=f"profiler-{target}", daemon=True)
+            session["thread"].start()
+        print(f"🔬 [PROFILE] {mode} capture of {target} started")
+    
+    @contextmanager
+    def capture(self, target):
+        """Profile the block if a cprofile session for target is running"""
+        session = self.sessions.get(target)
+        if session is None or session["mode"] != "cprofile":
+            yield
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler already owns this thread
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self.lock:
+                if session["stats"] is None:
+                    session["stats"] = pstats.Stats(profile)
+                else:
+                    session["stats"].add(profile)
+                session["captures"] += 1
+    
+    def _thread_idents(self, target):
+        if target == "http":
+            return set(self.http_threads)
+        prefixes = {"monitor": ("monitor", "sweep"), "poller": ("poller", "updates-")}[target]
+        return {t.ident for t in threading.enumerate() if t.name.startswith(prefixes)}
+    
+    def _sample(self, target, session, interval):
+        stacks = session["stacks"]
+        while not session["stop"].wait(interval):
+            frames = sys._current_frames()
+            for ident in self._thread_idents(target):
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if stack:
+                    key = ";".join(reversed(stack))
+                    stacks[key] = stacks.get(key, 0) + 1
+                    session["samples"] += 1
+    
+    def stop(self, target, top=25):
+        """End a session, dump it under PROFILE_DIR and return a summary"""
+        with self.lock:
+            session = self.sessions.pop(target, None)
+        if session is None:
+            raise ValueError(f"{target} is not being profiled")
+        session["stop"].set()
+        if session.get("thread") is not None:
+            session["thread"].join()
+        
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        result = {"target": target, "mode": session["mode"],
+                  "seconds": round(time.time() - session["started"], 1)}
+        
+        if session["mode"] == "cprofile":
+            result["captures"] = session["captures"]
+            if session["stats"] is None:
+                result["summary"] = []
+                return result
+            path = os.path.join(self.directory, f"{target}-{stamp}.prof")
+            session["stats"].dump_stats(path)
+            out = io.StringIO()
+            session["stats"].stream = out
+            session["stats"].sort_stats("cumulative").print_stats(top)
+            result["summary"] = [line for line in out.getvalue().splitlines() if line.strip()]
+        else:
+            path = os.path.join(self.directory, f"{target}-{stamp}.folded")
+            with open(path, "w") as f:
+                for stack, count in sorted(session["stacks"].items(), key=lambda item: -item[1]):
+                    f.write(f"{stack} {count}\n")
+            # Where the samples were taken (leaf frames)
+            leaves = {}
+            for stack, count in session["stacks"].items():
+                leaf = stack.rsplit(";", 1)[-1]
+                leaves[leaf] = leaves.get(leaf, 0) + count
+            total = session["samples"] or 1
+            result["samples"] = session["samples"]
+            result["summary"] = [f"{100 * count / total:5.1f}%  {leaf}"
+                                 for leaf, count in sorted(leaves.items(), key=lambda item: -item[1])[:top]]
+        
+        result["file"] = path
+        print(f"🔬 [PROFILE] {target} capture saved to {path}")
+        return result
+    
+    def status(self):
+        with self.lock:
+            return {target: {"mode": session["mode"],
+                             "running_for": round(time.time() - session["started"], 1),
+                             "captures": session["captures"], "samples": session["samples"]}
+                    for target, session in self.sessions.items()}
+
+profiler = Profiler(PROFILE_DIR)
+
 # ================= POLLER ===================================
-def poller():
+def poller(drop_pending=True):
     """Telegram update poller"""
     offset = 0
     print("🔄 Removing webhook...")
-    requests.post(f"{API}/deleteWebhook", json={"drop_pending_updates": True})
+    bot_api.call("deleteWebhook", {"drop_pending_updates": drop_pending})
     print("🤖 Bot Poller Started")
     
     while True:
         try:
-            updates = requests.post(
-                f"{API}/getUpdates",
-                json={"offset": offset, "timeout": 30}
-            ).json()
+            leader.wait_until_leader()
+            updates = bot_api.call("getUpdates", {
+                "offset": offset,
+                "timeout": 30,
+                "allowed_updates": ALLOWED_UPDATES
+            })
             
-            for upd in updates.get("result", []):
-                offset = upd["update_id"] + 1
-                handler(upd)
+            with profiler.capture("poller"):
+                for upd in updates.get("result", []):
+                    offset = upd["update_id"] + 1
+                    update_dispatch.submit(upd)
                 
         except Exception as e:
             print("Poller Error:", e)
             time.sleep(5)
 
+def register_webhook():
+    """Point Telegram at our /webhook route"""
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        print("❌ Webhook mode needs WEBHOOK_URL and WEBHOOK_SECRET")
+        return False
+    r = bot_api.call("setWebhook", {
+        "url": WEBHOOK_URL,
+        "secret_token": WEBHOOK_SECRET,
+        "allowed_updates": ALLOWED_UPDATES,
+        "max_connections": 100
+    })
+    print(f"🔗 Webhook {WEBHOOK_URL}: {r.get('description', r.get('ok'))}")
+    return bool(r.get("ok"))
+
+# ================= SNAPSHOT =================================
+class Snapshot:
+    """Materialized public ID list (plain and gzipped), rebuilt when ids_version moves.
+    
+    Only the leader builds: it writes content-addressed files and a
+    current.json manifest naming them, and every other process adopts the
+    manifest, so the table is scanned once per change rather than once per
+    process. Rebuilds are debounced: they wait for SNAPSHOT_DEBOUNCE seconds
+    without writes, but never longer than SNAPSHOT_MAX_DELAY after the first
+    change. Files are deleted keep seconds after a newer build replaced them.
+    """
+    def __init__(self, directory, poll, debounce, max_delay, keep):
+        # Absolute: send_file() resolves relative paths against the app root, not the cwd
+        self.directory = os.path.abspath(directory)
+        self.manifest = os.path.join(directory, "current.json")
+        self.poll = poll
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.keep = keep
+        self.current = None  # version, changes_seq, etag, path, gz_path, count, modified
+        self.manifest_mtime = None  # manifest st_mtime_ns we last adopted or wrote
+        self.lock = threading.Lock()  # one build at a time
+        self.seen_version = None
+        self.changed_at = None  # last time seen_version moved
+        self.pending_since = None  # first unbuilt change
+        self.superseded = {}  # path -> when a newer manifest replaced it (leader only)
+        self.scanned = False
+        self.counters = {"builds": 0, "reused": 0, "adopted": 0, "errors": 0}
+        self.build_ms = deque(maxlen=100)
+    
+    def build(self):
+        """Write the snapshot for the current data version (lock held)"""
+        started = time.perf_counter()
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = os.path.join(self.directory, f".ids-{os.getpid()}-{threading.get_ident()}")
+        digest = hashlib.blake2b(digest_size=16)
+        count = 0
+        
+        # One read transaction: the version and the rows belong together
+        with db_pool.reader() as db:
+            try:
+                db.execute("BEGIN")
+                version = db.execute("SELECT value FROM counters WHERE name='ids_version'").fetchone()[0]
+                changes_seq = latest_change_seq(db)
+                with open(tmp + ".txt", "wb") as plain, open(tmp + ".gz", "wb") as raw:
+                    # mtime=0 keeps the gzip bytes identical across processes
+                    with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=EXPORT_COMPRESS_LEVEL, mtime=0) as packed:
+                        separator = b""
+                        after = 0
+                        # Keyset pages on this connection, inside the same read transaction
+                        while True:
+                            batch = fetch_export_page(db, after, STREAM_BATCH_SIZE)
+                            if not batch:
+                                break
+                            after = batch[-1][0]
+                            chunk = separator + "\n".join(row[2] for row in batch).encode()
+                            separator = b"\n"
+                            count += len(batch)
+                            for out in (plain, packed):
+                                out.write(chunk)
+                            digest.update(chunk)
+                        if not count:
+                            chunk = b"No data available"
+                            for out in (plain, packed):
+                                out.write(chunk)
+                            digest.update(chunk)
+            finally:
+                db.rollback()
+        
+        etag = digest.hexdigest()
+        path = os.path.join(self.directory, f"ids-{etag}.txt")
+        gz_path = path + ".gz"
+        if os.path.exists(path) and os.path.exists(gz_path):
+            # Same content as an earlier build (ours or another process's);
+            # touch it so Last-Modified never moves backwards
+            os.remove(tmp + ".txt")
+            os.remove(tmp + ".gz")
+            os.utime(path)
+            os.utime(gz_path)
+            self.counters["reused"] += 1
+        else:
+            os.replace(tmp + ".gz", gz_path)
+            os.replace(tmp + ".txt", path)
+            self.counters["builds"] += 1
+        
+        self._publish({"version": version, "changes_seq": changes_seq, "etag": etag, "count": count,
+                       "file": os.path.basename(path), "modified": os.path.getmtime(path)})
+        self.pending_since = None
+        self.build_ms.append((time.perf_counter() - started) * 1000)
+        return self.current
+    
+    def _load(self, manifest):
+        """Manifest dict -> current (absolute paths, datetime Last-Modified)"""
+        path = os.path.join(self.directory, manifest["file"])
+        return dict(manifest, path=path, gz_path=path + ".gz",
+                    modified=datetime.utcfromtimestamp(manifest["modified"]))
+    
+    def _publish(self, manifest):
+        """Point current.json at a new build and retire the files it replaces"""
+        now = time.time()
+        try:
+            with open(self.manifest) as f:
+                previous = json.load(f)["file"]
+        except (OSError, ValueError, KeyError):
+            previous = None
+        tmp = f"{self.manifest}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, self.manifest)
+        self.manifest_mtime = os.stat(self.manifest).st_mtime_ns
+        self.current = self._load(manifest)
+        
+        if previous and previous != manifest["file"]:
+            for name in (previous, previous + ".gz"):
+                self.superseded.setdefault(os.path.join(self.directory, name), now)
+        if not self.scanned:
+            # Leftovers from earlier leaders get a full grace period too
+            self.scanned = True
+            for name in os.listdir(self.directory):
+                if name.startswith(("ids-", ".ids-")):
+                    self.superseded.setdefault(os.path.join(self.directory, name), now)
+        for path in (self.current["path"], self.current["gz_path"]):
+            self.superseded.pop(path, None)
+        self._cleanup()
+    
+    def _cleanup(self):
+        """Delete files superseded more than keep seconds ago"""
+        cutoff = time.time() - self.keep
+        for path, superseded_at in list(self.superseded.items()):
+            if superseded_at < cutoff:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                del self.superseded[path]
+    
+    def adopt(self):
+        """Switch to the manifest's build if it changed; True if it did"""
+        try:
+            mtime = os.stat(self.manifest).st_mtime_ns
+            if mtime == self.manifest_mtime:
+                return False
+            with open(self.manifest) as f:
+                current = self._load(json.load(f))
+        except (OSError, ValueError, KeyError):
+            return False
+        self.manifest_mtime = mtime
+        self.current = current
+        self.counters["adopted"] += 1
+        return True
+    
+    def get(self):
+        """Current snapshot: the manifest's, else built by the leader.
+        
+        None on other processes until the leader publishes the first one, so
+        cold workers never run a full build inside a request.
+        """
+        if self.current is None:
+            with self.lock:
+                if self.current is None and not self.adopt() and leader.is_leader():
+                    self.build()
+        return self.current
+    
+    def reload(self):
+        """Called when our files are gone: re-read the manifest, else (leader) build"""
+        with self.lock:
+            self.manifest_mtime = None
+            if self.adopt() and os.path.exists(self.current["path"]):
+                return self.current
+            if leader.is_leader():
+                return self.build()
+        return None
+    
+    def refresh(self):
+        """Leader: rebuild if ids_version moved (debounced). Others: adopt the manifest.
+        
+        Returns "built", "adopted" or None.
+        """
+        if not leader.is_leader():
+            return "adopted" if self.adopt() else None
+        
+        version = get_counter('ids_version')
+        now = time.monotonic()
+        if version != self.seen_version:
+            self.seen_version = version
+            self.changed_at = now
+        if self.current is not None and version == self.current["version"]:
+            return None
+        if self.pending_since is None:
+            self.pending_since = now
+        if (self.current is None or now - self.changed_at >= self.debounce
+                or now - self.pending_since >= self.max_delay):
+            with self.lock:
+                self.build()
+            return "built"
+        return None
+    
+    def run(self):
+        """Background loop keeping the snapshot fresh"""
+        print("📸 Snapshot builder started")
+        while True:
+            try:
+                outcome = self.refresh()
+                if outcome == "built":
+                    print(f"📸 [SNAPSHOT] v{self.current['version']}: {self.current['count']} IDs "
+                          f"in {self.build_ms[-1]:.0f}ms")
+            except Exception as e:
+                self.counters["errors"] += 1
+                print(f"Snapshot error: {e}")
+            time.sleep(self.poll)
+    
+    def stats(self):
+        current = self.current or {}
+        return dict(self.counters, version=current.get("version"), count=current.get("count"),
+                    etag=current.get("etag"), superseded_files=len(self.superseded),
+                    build_ms=percentiles(self.build_ms))
+
+snapshot = Snapshot(SNAPSHOT_DIR, SNAPSHOT_POLL, SNAPSHOT_DEBOUNCE, SNAPSHOT_MAX_DELAY, SNAPSHOT_KEEP)
+
 # ================= FLASK APP ================================
 app = Flask(__name__)
+# Also caps chunked and multipart bodies, which carry no usable Content-Length
+app.config["MAX_CONTENT_LENGTH"] = IMPORT_MAX_BYTES
+
+@app.before_request
+def trace_request():
+    """Open the slow-log trace (and profiler capture) for this request"""
+    g.request_started = time.perf_counter()
+    slow_log.begin()
+    profiler.http_threads.add(threading.get_ident())
+    g.profile = profiler.capture("http")
+    g.profile.__enter__()
+
+class TracedBody:
+    """Streamed response body that closes the request trace once it has been sent"""
+    def __init__(self, body, finish):
+        self.body = body
+        self.finish = finish
+    
+    def __iter__(self):
+        return iter(self.body)
+    
+    def close(self):
+        try:
+            if hasattr(self.body, "close"):
+                self.body.close()
+        finally:
+            self.finish()
+
+def end_request_trace(profile, started, path, status):
+    """Close the profiler capture and record the request in the slow log"""
+    if profile is not None:
+        profile.__exit__(None, None, None)
+    profiler.http_threads.discard(threading.get_ident())
+    trace = slow_log.end()
+    if started is None or trace is None:
+        return
+    ms = (time.perf_counter() - started) * 1000
+    if slow_log.is_slow("http", ms):
+        slow_log.record("http", path, ms, status=status,
+                        other_ms=ms - trace["sql_ms"] - trace["api_ms"], **trace)
+
+@app.after_request
+def note_status(response):
+    g.status_code = response.status_code
+    if response.is_streamed and not response.direct_passthrough:
+        # Generated bodies (/export) run after teardown on this same thread -
+        # keep the capture open until the last chunk is written
+        g.trace_deferred = True
+        finish = functools.partial(end_request_trace, g.pop("profile", None),
+                                   g.pop("request_started", None), request.path,
+                                   response.status_code)
+        response.response = TracedBody(response.response, finish)
+    return response
+
+@app.teardown_request
+def finish_request_trace(error=None):
+    if g.pop("trace_deferred", False):
+        return
+    end_request_trace(g.pop("profile", None), g.pop("request_started", None),
+                      request.path, g.get("status_code", 500))
+
+@app.route("/webhook", methods=["POST"])
+def webhook():
+    """Telegram webhook ingestion - validate, enqueue, acknowledge"""
+    if UPDATE_MODE != "webhook":
+        return Response("Not Found", mimetype='text/plain', status=404)
+    
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not WEBHOOK_SECRET or not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+        return Response("Unauthorized", mimetype='text/plain', status=403)
+    
+    update = request.get_json(silent=True)
+    if not isinstance(update, dict) or "update_id" not in update:
+        return Response("Bad Request", mimetype='text/plain', status=400)
+    
+    # Full queue: non-2xx makes Telegram redeliver later
+    if not update_dispatch.submit(update, block=False):
+        return Response("Busy", mimetype='text/plain', status=503)
+    
+    return Response("OK", mimetype='text/plain')
+
+def snapshot_pending():
+    """503 while no snapshot has been published yet (the leader builds it within SNAPSHOT_POLL)"""
+    response = Response("Snapshot not ready, retry shortly", mimetype='text/plain', status=503)
+    response.headers['Retry-After'] = str(max(1, math.ceil(SNAPSHOT_POLL)))
+    return response
 
 @app.route("/")
 def raw_output():
-    """Public raw text endpoint - one ID per line"""
-    ids = get_all_ids()
-    if not ids:
-        return Response("No data available", mimetype='text/plain')
-    
-    response_text = "\n".join(ids)
-    return Response(response_text, mimetype='text/plain', headers={
+    """Public raw text endpoint - one ID per line, served from the snapshot file"""
+    current = snapshot.get()
+    if current is None:
+        return snapshot_pending()
+    packed = request.accept_encodings["gzip"] > 0
+    try:
+        response = send_file(current["gz_path"] if packed else current["path"],
+                             mimetype='text/plain', etag=False, conditional=False)
+    except FileNotFoundError:
+        # Retired while we still pointed at it (e.g. we missed manifest updates)
+        current = snapshot.reload()
+        if current is None:
+            return snapshot_pending()
+        response = send_file(current["gz_path"] if packed else current["path"],
+                             mimetype='text/plain', etag=False, conditional=False)
+    # The gzipped body is a different representation, so it gets its own tag
+    response.set_etag(current["etag"] + ("-gz" if packed else ""))
+    response.last_modified = current["modified"]
+    if packed:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers.update({
         'Content-Type': 'text/plain; charset=utf-8',
         'Cache-Control': 'no-cache',
-        'Access-Control-Allow-Origin': '*'
+        'Vary': 'Accept-Encoding',
+        'Access-Control-Allow-Origin': '*',
+        # Resume point for /changes (replaying a little extra is harmless)
+        'X-Changes-Seq': str(current["changes_seq"])
     })
+    return response.make_conditional(request)
+
+@app.route("/changes")
+def changes():
+    """Incremental feed of the public list: ?since=<seq>&limit=N (410 once since is compacted away)"""
+    try:
+        since = int(request.args.get("since", 0))
+        limit = min(int(request.args.get("limit", CHANGES_PAGE_SIZE)), CHANGES_PAGE_SIZE * 10)
+    except ValueError:
+        return jsonify({"error": "since and limit must be integers"}), 400
+    if since < 0 or limit <= 0:
+        return jsonify({"error": "since must be >= 0 and limit positive"}), 400
+    
+    # Owners' Telegram ids and the full log are only shown to admins
+    admin = request.args.get("key") == ADMIN_KEY
+    floor, latest, rows = get_changes(since, limit, public=not admin)
+    if since < floor:
+        return jsonify({
+            "error": "since is older than the retained change log; resync from /",
+            "floor": floor, "latest": latest
+        }), 410
+    
+    entries = []
+    for row in rows:
+        entry = {"seq": row['seq'], "uid": row['uid'], "op": row['op'],
+                 "active": row['status'] == 'active', "at": row['at']}
+        if admin:
+            entry.update(tg=row['tg'], status=row['status'], prev_status=row['prev_status'])
+        entries.append(entry)
+    # A short page means everything up to latest was read (hidden rows included)
+    next_seq = rows[-1]['seq'] if len(rows) == limit else max(since, latest)
+    response = jsonify({"since": since, "next": next_seq, "latest": latest, "floor": floor,
+                        "has_more": next_seq < latest, "changes": entries})
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
 
 @app.route("/stats")
 def public_stats():
@@ -918,9 +3551,16 @@ Scan Interval: {SCAN_TIME}s
 
 @app.route("/count")
 def count():
-    """Just the count of active IDs"""
-    ids = get_all_ids()
-    return Response(str(len(ids)), mimetype='text/plain')
+    """Just the count of active IDs (from the snapshot, with ETag)"""
+    current = snapshot.get()
+    if current is None:
+        # No snapshot published yet: the live counter is just as cheap
+        return Response(str(count_active_ids()), mimetype='text/plain', headers={'Cache-Control': 'no-cache'})
+    response = Response(str(current["count"]), mimetype='text/plain')
+    response.set_etag(f"count-{current['count']}")
+    response.last_modified = current["modified"]
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 @app.route("/admin")
 def admin_panel():
@@ -935,15 +3575,7 @@ def admin_panel():
     suspended = get_suspended_users()
     
     # Get recent deletions
-    db = get_db()
-    cur = db.cursor()
-    cur.execute("""
-        SELECT tg, deleted_at, ids_count 
-        FROM deleted_users_log 
-        ORDER BY deleted_at DESC 
-        LIMIT 10
-    """)
-    recent_deletions = cur.fetchall()
+    recent_deletions = get_recent_deletions(10)
     
     admin_text = f"""ADMIN PANEL - VISHAL X BOT (ENTERPRISE v2.2)
 Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
@@ -967,7 +3599,7 @@ Scan: {SCAN_TIME}s
         tg, until = row['tg'], row['suspended_until']
         time_left = ""
         if until:
-            until_dt = datetime.strptime(until, '%Y-%m-%d %H:%M:%S')
+            until_dt = parse_timestamp(until)
             sec_left = (until_dt - datetime.now()).seconds
             hours = sec_left // 3600
             minutes = (sec_left % 3600) // 60
@@ -979,20 +3611,80 @@ Scan: {SCAN_TIME}s
         admin_text += f"\n• {row['tg']} ({row['ids_count']} IDs) at {row['deleted_at']}"
     
     admin_text += f"\n\n🔗 ENDPOINTS:\nRAW: /\nEXPORT: /export?key={ADMIN_KEY}"
+    admin_text += f"\nIMPORT: POST /admin/import?key={ADMIN_KEY}&tg=USER_ID"
     
     return Response(admin_text, mimetype='text/plain')
 
+EXPORT_FORMATS = {"txt": "text/plain", "ndjson": "application/x-ndjson", "csv": "text/csv"}
+EXPORT_COLUMNS = ("rowid", "tg", "uid", "status", "added")
+
+def compress_stream(chunks, encoding):
+    """Compress a text stream on the fly (gzip or zlib-wrapped deflate)"""
+    wbits = 16 + zlib.MAX_WBITS if encoding == "gzip" else zlib.MAX_WBITS
+    compressor = zlib.compressobj(EXPORT_COMPRESS_LEVEL, zlib.DEFLATED, wbits)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+def format_export(batches, fmt):
+    """Render export row batches as txt (IDs only), ndjson or csv"""
+    if fmt == "csv":
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow(EXPORT_COLUMNS)
+        yield out.getvalue()
+        for rows in batches:
+            out.seek(0)
+            out.truncate()
+            writer.writerows(rows)
+            yield out.getvalue()
+    elif fmt == "ndjson":
+        for rows in batches:
+            yield "".join(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + "\n" for row in rows)
+    else:
+        separator = ""
+        for rows in batches:
+            yield separator + "\n".join(row[2] for row in rows)
+            separator = "\n"
+
 @app.route("/export")
 def admin_export():
-    """Admin export with metadata"""
+    """Admin export: ?format=txt|ndjson|csv&status=active|suspended|all&after=<rowid>&limit=N
+    
+    Streamed in batches, gzip/deflate compressed when Accept-Encoding allows.
+    Paged exports return X-Next-After for the following request.
+    """
     key = request.args.get("key")
     if key != ADMIN_KEY:
         return Response("Unauthorized", mimetype='text/plain', status=403)
     
-    ids = get_all_ids()
-    total = len(ids)
+    fmt = request.args.get("format", "txt")
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": f"format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+    status = request.args.get("status", "active")
+    if status not in ("active", "suspended", "all"):
+        return jsonify({"error": "status must be active, suspended or all"}), 400
+    status = None if status == "all" else status
+    try:
+        after = int(request.args.get("after", 0))
+        limit = int(request.args["limit"]) if "limit" in request.args else None
+    except ValueError:
+        return jsonify({"error": "after and limit must be integers"}), 400
+    if limit is not None and limit <= 0:
+        return jsonify({"error": "limit must be positive"}), 400
+    
+    headers = {"Vary": "Accept-Encoding"}
+    if limit is not None:
+        next_after = export_next_after(after, limit, status)
+        if next_after is not None:
+            headers["X-Next-After"] = str(next_after)
     
-    export_text = f"""# VISHAL X BOT EXPORT - ENTERPRISE EDITION v2.2
+    chunks = format_export(iter_export_rows(after, limit, status), fmt)
+    if fmt == "txt" and after == 0 and status == 'active':
+        total = count_active_ids()
+        header = f"""# VISHAL X BOT EXPORT - ENTERPRISE EDITION v2.2
 # Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
 # Total IDs: {total}
 # Channel: {CHANNEL}
@@ -1000,12 +3692,85 @@ def admin_export():
 # Double-check: {DOUBLE_CHECK_DELETE}
 # Format: One ID per line
 """
-    export_text += "\n".join(ids)
-    return Response(export_text, mimetype='text/plain')
+        chunks = itertools.chain([header], chunks)
+    
+    encoding = request.accept_encodings.best_match(["gzip", "deflate"])
+    if encoding:
+        headers["Content-Encoding"] = encoding
+        chunks = compress_stream(chunks, encoding)
+    
+    return Response(chunks, mimetype=EXPORT_FORMATS[fmt], headers=headers)
+
+@app.route("/admin/import", methods=["POST"])
+def admin_import():
+    """Bulk import: POST ?key=&tg=<owner> with a text body or a multipart 'file' field"""
+    key = request.args.get("key")
+    if key != ADMIN_KEY:
+        return Response("Unauthorized", mimetype='text/plain', status=403)
+    
+    try:
+        tg = int(request.args.get("tg", ""))
+    except ValueError:
+        return jsonify({"error": "tg must be a Telegram user id"}), 400
+    if request.content_length and request.content_length > IMPORT_MAX_BYTES:
+        return jsonify({"error": f"body larger than {IMPORT_MAX_BYTES} bytes"}), 413
+    
+    upload = request.files.get("file") if request.mimetype == "multipart/form-data" else None
+    summary = import_ids(tg, upload.stream if upload else request.stream)
+    summary["total_ids"] = count_user_ids(tg)
+    return jsonify(summary), (500 if "error" in summary else 200)
+
+@app.route("/admin/profile", methods=["GET", "POST"])
+def admin_profile():
+    """Profiling controls: ?action=start|stop|status&target=monitor|poller|http&mode=cprofile|sample"""
+    key = request.args.get("key")
+    if key != ADMIN_KEY:
+        return Response("Unauthorized", mimetype='text/plain', status=403)
+    
+    action = request.args.get("action", "status")
+    target = request.args.get("target", "monitor")
+    try:
+        if action == "start":
+            interval = float(request.args.get("interval_ms", 5)) / 1000
+            profiler.start(target, request.args.get("mode", "cprofile"), interval)
+            return jsonify({"started": target, "profiling": profiler.status()})
+        if action == "stop":
+            return jsonify(profiler.stop(target, int(request.args.get("top", 25))))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"profiling": profiler.status(), "directory": os.path.abspath(PROFILE_DIR)})
+
+@app.route("/admin/slow", methods=["GET", "POST"])
+def admin_slow():
+    """Slow-operation log; ?handler_ms=&sql_ms=&api_ms=&http_ms= change thresholds live"""
+    key = request.args.get("key")
+    if key != ADMIN_KEY:
+        return Response("Unauthorized", mimetype='text/plain', status=403)
+    
+    for kind in slow_log.thresholds:
+        value = request.args.get(f"{kind}_ms")
+        if value is not None:
+            try:
+                slow_log.thresholds[kind] = float(value)
+            except ValueError:
+                return jsonify({"error": f"{kind}_ms must be a number"}), 400
+    
+    try:
+        limit = int(request.args.get("limit", 100))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    if limit <= 0:
+        return jsonify({"error": "limit must be positive"}), 400
+    
+    return jsonify({
+        "thresholds_ms": slow_log.thresholds,
+        "entries": slow_log.recent(limit, request.args.get("kind"))
+    })
 
 @app.route("/health")
 def health():
-    """Health check endpoint"""
+    """Health check endpoint (?key= adds the costlier per-user breakdowns)"""
+    admin = request.args.get("key") == ADMIN_KEY
     return jsonify({
         "status": "online",
         "timestamp": datetime.now().isoformat(),
@@ -1015,10 +3780,359 @@ def health():
         "suspension_hours": SUSPEND_DURATION//3600,
         "double_check": DOUBLE_CHECK_DELETE,
         "scan_interval": SCAN_TIME,
-        "total_ids": len(get_all_ids()),
-        "database_threads": len(db_manager.connections)
+        "total_ids": count_active_ids(),
+        "database_pool": db_pool.stats(),
+        "known_users": known_users.stats(),
+        "id_counts": id_counts.stats(),
+        "snapshot": snapshot.stats(),
+        "last_sweep": sweep_stats,
+        "scheduler": scheduler.stats(detail=admin),
+        "expiry": expiry.stats(),
+        "leader": leader.stats(detail=admin),
+        "shards": shards.stats(detail=admin),
+        "http_pool": bot_api.stats(),
+        "member_cache": member_cache.stats(),
+        "outbound": outbound.stats(),
+        "updates": update_dispatch.stats()
+    })
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus text exposition of latency histograms and event counters"""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route("/shards")
+def shard_status():
+    """Per-shard owner, progress and lag across all processes - requires key parameter"""
+    key = request.args.get("key")
+    if key != ADMIN_KEY:
+        return Response("Unauthorized", mimetype='text/plain', status=403)
+    
+    return jsonify({
+        "process": shards.stats(detail=True),
+        "shards": shard_overview()
     })
 
+# ================= LEADER ELECTION ==========================
+# One identity per process for every lease it holds
+PROCESS_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+def acquire_lease(name, owner, ttl):
+    """Take or renew a lease row; returns (held, took_over_from_someone)"""
+    with db_pool.writer() as db:
+        cur = db.cursor()
+        now = time.time()
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            cur.execute("SELECT owner, expires_at FROM leases WHERE name=?", (name,))
+            row = cur.fetchone()
+            if row and row['owner'] != owner and row['expires_at'] > now:
+                db.rollback()
+                return False, False
+            
+            if row and row['owner'] == owner:
+                cur.execute("UPDATE leases SET expires_at=? WHERE name=?", (now + ttl, name))
+            else:
+                cur.execute("""
+                    INSERT OR REPLACE INTO leases (name, owner, expires_at, acquired_at)
+                    VALUES(?,?,?,?)
+                """, (name, owner, now + ttl, now))
+            db.commit()
+            return True, bool(row) and row['owner'] != owner
+        except Exception as e:
+            db.rollback()
+            print(f"[LEASE] Error on {name}: {e}")
+            return False, False
+
+def release_lease(name, owner):
+    """Drop a lease we hold so another process can take it immediately"""
+    with db_pool.writer() as db:
+        db.execute("DELETE FROM leases WHERE name=? AND owner=?", (name, owner))
+        db.commit()
+
+class LeaderElector:
+    """SQLite lease row with heartbeat and takeover; one holder across processes"""
+    def __init__(self, name, ttl, heartbeat):
+        self.name = name
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.owner = PROCESS_ID
+        self.leading = threading.Event()
+        self.on_elected = []  # callbacks run once, the first time we win
+        self.elected_once = False
+        self.started = False
+        self.lock = threading.Lock()
+    
+    def try_acquire(self):
+        """Take or renew the lease; returns (leader, took_over_from_someone)"""
+        try:
+            return acquire_lease(self.name, self.owner, self.ttl)
+        except Exception as e:
+            # e.g. pool checkout timeout - we could not renew, so act as if we lost it
+            print(f"[LEASE] Error on {self.name}: {e}")
+            return False, False
+    
+    def release(self):
+        """Give the lease up so another process can take over immediately"""
+        if not self.leading.is_set():
+            return
+        self.leading.clear()
+        release_lease(self.name, self.owner)
+    
+    def run(self):
+        while True:
+            try:
+                leading, takeover = self.try_acquire()
+                if leading and not self.leading.is_set():
+                    print(f"👑 [LEADER] {self.owner} elected{' (takeover)' if takeover else ''}")
+                    self.leading.set()
+                    if not self.elected_once:
+                        self.elected_once = True
+                        for callback in self.on_elected:
+                            callback(takeover)
+                elif not leading and self.leading.is_set():
+                    print(f"[LEADER] {self.owner} lost the lease, pausing background work")
+                    self.leading.clear()
+            except Exception as e:
+                # Never leave leading set without a renewed lease
+                print("Leader heartbeat error:", e)
+                self.leading.clear()
+            time.sleep(self.heartbeat)
+    
+    def start(self):
+        """Start the heartbeat thread (idempotent)"""
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        threading.Thread(target=self.run, name="leader", daemon=True).start()
+    
+    def is_leader(self):
+        return self.leading.is_set()
+    
+    def wait_until_leader(self):
+        """Block background loops while another process holds the lease"""
+        self.leading.wait()
+    
+    def stats(self, detail=False):
+        """Lease state; detail=True adds this process and the holder (hostname:pid)"""
+        with db_pool.reader() as db:
+            row = db.execute("SELECT owner, expires_at FROM leases WHERE name=?", (self.name,)).fetchone()
+        stats = {
+            "is_leader": self.is_leader(),
+            "lease_expires_in": round(row['expires_at'] - time.time(), 1) if row else None
+        }
+        if detail:
+            stats.update(owner=self.owner, lease_holder=row['owner'] if row else None)
+        return stats
+
+leader = LeaderElector("background", LEASE_TTL, LEASE_HEARTBEAT)
+
+def change_compactor():
+    """Trim the /changes log to CHANGES_RETENTION / CHANGES_MAX_ROWS (leader only)"""
+    while True:
+        try:
+            leader.wait_until_leader()
+            floor = compact_changes()
+            print(f"🧹 [CHANGES] Change log compacted, floor at seq {floor}")
+        except Exception as e:
+            print(f"Change compaction error: {e}")
+        time.sleep(CHANGES_COMPACT_INTERVAL)
+
+def start_background_workers(takeover):
+    """Leader-only work: suspension expiry, change-log compaction and update ingestion"""
+    threading.Thread(target=expiry.run, name="expiry", daemon=True).start()
+    threading.Thread(target=change_compactor, name="changes", daemon=True).start()
+    if UPDATE_MODE == "webhook":
+        register_webhook()
+    else:
+        # A takeover keeps updates the previous leader had not fetched yet
+        threading.Thread(target=poller, args=(not takeover,), name="poller", daemon=True).start()
+
+leader.on_elected.append(start_background_workers)
+
+# ================= MONITOR SHARDS ===========================
+class ShardCoordinator:
+    """Splits the sweep into tg % count shards; each is leased by one process.
+    
+    Every process keeps a presence lease and holds a fair share of shards
+    (ceil(count / live processes)). Leases of a dead process expire, so the
+    survivors' share grows and they claim its shards on the next heartbeat.
+    """
+    def __init__(self, count, ttl, heartbeat, owner):
+        self.count = max(1, count)
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.owner = owner
+        self.owned = frozenset()
+        self.changed = threading.Event()  # ownership moved; monitor reloads the schedule
+        self.has_shards = threading.Event()
+        self.lock = threading.Lock()
+        self.started = False
+        self.live_members = 0
+        self.progress = {}  # shard -> checks done by this process
+    
+    def shard_of(self, tg):
+        return int(tg) % self.count
+    
+    def owns(self, tg):
+        return self.shard_of(tg) in self.owned
+    
+    def record(self, tg, api_error):
+        """Count one membership check against its shard"""
+        with self.lock:
+            entry = self.progress.setdefault(self.shard_of(tg), {"checked": 0, "api_errors": 0, "last_check": None})
+            entry["checked"] += 1
+            if api_error:
+                entry["api_errors"] += 1
+            entry["last_check"] = time.time()
+    
+    def rebalance(self):
+        """Renew presence and held shards, shed extras, claim free ones"""
+        acquire_lease(f"monitor-member:{self.owner}", self.owner, self.ttl)
+        now = time.time()
+        with db_pool.reader() as db:
+            self.live_members = db.execute("""
+                SELECT COUNT(*) FROM leases WHERE name LIKE 'monitor-member:%' AND expires_at > ?
+            """, (now,)).fetchone()[0] or 1
+        # The Bot API budget is global: each live process gets an equal slice
+        api_limiter.set_rate(API_RATE_LIMIT / self.live_members, max(1, API_BURST // self.live_members))
+        fair_share = math.ceil(self.count / self.live_members)
+        
+        owned = {shard for shard in self.owned if acquire_lease(f"monitor-shard-{shard}", self.owner, self.ttl)[0]}
+        
+        # Hand surplus shards back so newly started processes get work
+        while len(owned) > fair_share:
+            shard = max(owned)
+            owned.discard(shard)
+            release_lease(f"monitor-shard-{shard}", self.owner)
+        
+        for shard in range(self.count):
+            if len(owned) >= fair_share:
+                break
+            if shard not in owned:
+                held, takeover = acquire_lease(f"monitor-shard-{shard}", self.owner, self.ttl)
+                if held:
+                    owned.add(shard)
+                    if takeover:
+                        print(f"[SHARDS] Took over shard {shard} from an expired owner")
+        
+        if owned != self.owned:
+            print(f"🧩 [SHARDS] {self.owner} owns {sorted(owned)} of {self.count} "
+                  f"({self.live_members} live processes)")
+            self.owned = frozenset(owned)
+            self.changed.set()
+            if owned:
+                self.has_shards.set()
+            else:
+                self.has_shards.clear()
+            with scheduler.cond:
+                scheduler.cond.notify()
+    
+    def run(self):
+        while True:
+            try:
+                self.rebalance()
+            except Exception as e:
+                print("Shard heartbeat error:", e)
+            time.sleep(self.heartbeat)
+    
+    def start(self):
+        """Start the heartbeat thread (idempotent)"""
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        threading.Thread(target=self.run, name="shards", daemon=True).start()
+    
+    def wait_until_owner(self):
+        """Block the monitor while this process holds no shards"""
+        self.has_shards.wait()
+    
+    def release(self):
+        """Give up every shard and the presence lease"""
+        owned, self.owned = self.owned, frozenset()
+        self.has_shards.clear()
+        for shard in owned:
+            release_lease(f"monitor-shard-{shard}", self.owner)
+        release_lease(f"monitor-member:{self.owner}", self.owner)
+    
+    def stats(self, detail=False):
+        """Shards held by this process with progress; detail=True adds per-shard check lag"""
+        now = time.time()
+        lag = {}
+        if detail:
+            # Copy under the lock, walk it outside so the monitor is not stalled
+            with scheduler.cond:
+                items = list(scheduler.due_at.items())
+            for tg, due in items:
+                if due <= now:
+                    entry = lag.setdefault(self.shard_of(tg), [0, 0.0])
+                    entry[0] += 1
+                    entry[1] = max(entry[1], now - due)
+        with self.lock:
+            progress = {shard: dict(entry) for shard, entry in self.progress.items()}
+        owned = {}
+        for shard in sorted(self.owned):
+            entry = progress.get(shard, {"checked": 0, "api_errors": 0, "last_check": None})
+            owned[str(shard)] = {
+                "checked": entry["checked"],
+                "api_errors": entry["api_errors"],
+                "last_check_ago": round(now - entry["last_check"], 1) if entry["last_check"] else None
+            }
+            if detail:
+                overdue, max_lag = lag.get(shard, [0, 0.0])
+                owned[str(shard)].update(overdue=overdue, lag_seconds=round(max_lag, 1))
+        return {
+            "shards": self.count,
+            "live_processes": self.live_members,
+            "api_rate_limit": round(api_limiter.rate, 2),
+            "owned": owned
+        }
+
+shards = ShardCoordinator(MONITOR_SHARDS, LEASE_TTL, LEASE_HEARTBEAT, PROCESS_ID)
+
+def shard_overview():
+    """Every shard's owner, active users and overdue checks, from the shared database"""
+    with db_pool.reader() as db:
+        now = time.time()
+        leases = {
+            row['name']: row for row in db.execute(
+                "SELECT name, owner, expires_at FROM leases WHERE name LIKE 'monitor-shard-%'"
+            )
+        }
+        rows = db.execute("""
+            SELECT tg % ? AS shard, COUNT(*) AS active,
+                   SUM(next_check IS NULL OR next_check <= ?) AS overdue,
+                   MIN(next_check) AS oldest_due
+            FROM user_states WHERE status='active'
+            GROUP BY shard
+        """, (shards.count, now)).fetchall()
+        users = {row['shard']: row for row in rows}
+        
+        overview = []
+        for shard in range(shards.count):
+            lease = leases.get(f"monitor-shard-{shard}")
+            row = users.get(shard)
+            live = lease is not None and lease['expires_at'] > now
+            oldest_due = row['oldest_due'] if row else None
+            overview.append({
+                "shard": shard,
+                "owner": lease['owner'] if live else None,
+                "active_users": row['active'] if row else 0,
+                "overdue": row['overdue'] or 0 if row else 0,
+                "lag_seconds": round(max(0.0, now - oldest_due), 1) if oldest_due else 0.0
+            })
+        return overview
+
+def start_background():
+    """Join leader election and monitor sharding; every process keeps serving Flask reads"""
+    known_users.load()
+    threading.Thread(target=snapshot.run, name="snapshot", daemon=True).start()
+    leader.start()
+    shards.start()
+    threading.Thread(target=monitor, name="monitor", daemon=True).start()
+
 # ================= CLEANUP ==================================
 import atexit
 
@@ -1026,7 +4140,13 @@ import atexit
 def cleanup():
     """Cleanup resources on exit"""
     print("🔄 Cleaning up resources...")
-    db_manager.close_all()
+    try:
+        leader.release()
+        shards.release()
+    except Exception as e:
+        print("Lease release error:", e)
+    db_pool.close_all()
+    bot_api.close()
     print("✅ Cleanup completed")
 
 # ================= RUN ======================================
@@ -1043,6 +4163,7 @@ if __name__ == "__main__":
     print(f"📡 SCAN INTERVAL: {SCAN_TIME} seconds")
     print(f"🌐 PUBLIC ENDPOINT: http://localhost:{PORT}/")
     print(f"📊 STATS: http://localhost:{PORT}/stats")
+    print(f"📥 UPDATES: {UPDATE_MODE}")
     print("="*70)
     print("✅ FINAL PROTECTION FLOW:")
     print("1. /start → ensure_user_state() → user_states entry created")
@@ -1054,9 +4175,8 @@ if __name__ == "__main__":
     print("7. Rejoin anytime → full restore")
     print("="*70 + "\n")
     
-    # Start monitor and poller in threads
-    threading.Thread(target=monitor, daemon=True).start()
-    threading.Thread(target=poller, daemon=True).start()
+    # Monitor, suspension expiry and update ingestion run in the elected process
+    start_background()
     
     # Start Flask app
     app.run(host="0.0.0.0", port=PORT, debug=False)
\ No newline at end of file
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# ============================================================
+# Fake Telegram Bot API - in-process stand-in for benchmarks
+# ============================================================
+import json, random, threading, time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class FakeBotAPI:
+    """Serves the Bot API methods app.py uses, with injectable latency/faults.
+
+    latency     seconds added to every call (plus up to `jitter` seconds)
+    error_rate  fraction of calls answered with HTTP 500
+    rate_429    fraction of calls answered with 429 + retry_after
+    churn       chance per getChatMember that the user's membership flips
+    members     fraction of users who start out in the channel
+    """
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, rate_429=0.0,
+                 retry_after=1, churn=0.0, members=1.0, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.churn = churn
+        self.members = members
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.membership = {}  # tg -> bool, decided on first lookup
+        self.updates = []  # pending updates for getUpdates
+        self.update_id = 0
+        self.has_updates = threading.Condition(self.lock)
+        self.sent = defaultdict(list)  # chat_id -> [monotonic send times]
+        self.calls = defaultdict(int)
+        self.faults = {"500": 0, "429": 0}
+        self.files = {}  # file_id -> bytes served under /file/bot<token>/
+        self.server = None
+
+    # ---------------- control ----------------
+    def start(self, host="127.0.0.1", port=0):
+        """Listen on a free port in a daemon thread; returns API_BASE"""
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, like api.telegram.org
+            disable_nagle_algorithm = True  # headers and body go out as separate writes
+
+            def do_GET(self):
+                if "/file/" not in self.path:
+                    return self.do_POST()
+                data = fake.files.get(self.path.rsplit("/", 1)[-1])
+                self.send_response(200 if data is not None else 404)
+                self.send_header("Content-Length", str(len(data or b"")))
+                self.end_headers()
+                self.wfile.write(data or b"")
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b"{}"
+                method = self.path.rsplit("/", 1)[-1]
+                status, payload = fake.dispatch(method, json.loads(body or b"{}"))
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://{host}:{self.server.server_address[1]}"
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def push_update(self, update):
+        """Queue an update for the next getUpdates; returns its update_id"""
+        with self.lock:
+            self.update_id += 1
+            update = dict(update, update_id=self.update_id)
+            self.updates.append(update)
+            self.has_updates.notify_all()
+            return self.update_id
+
+    def add_file(self, data):
+        """Make bytes downloadable via getFile; returns the file_id"""
+        with self.lock:
+            file_id = f"file{len(self.files) + 1}"
+            self.files[file_id] = data
+            return file_id
+
+    def first_send_after(self, chat_id, since):
+        """Monotonic time of the first message to chat_id at/after `since`"""
+        with self.lock:
+            return next((t for t in self.sent.get(chat_id, ()) if t >= since), None)
+
+    def stats(self):
+        with self.lock:
+            return {"calls": dict(self.calls), "faults": dict(self.faults)}
+
+    # ---------------- Bot API ----------------
+    def dispatch(self, method, payload):
+        with self.lock:
+            self.calls[method] += 1
+            roll = self.random.random()
+
+        if method != "getUpdates":
+            delay = self.latency + (self.random.random() * self.jitter if self.jitter else 0)
+            if delay:
+                time.sleep(delay)
+            if roll < self.error_rate:
+                with self.lock:
+                    self.faults["500"] += 1
+                return 500, {"ok": False, "error_code": 500, "description": "Internal Server Error"}
+            if roll < self.error_rate + self.rate_429:
+                with self.lock:
+                    self.faults["429"] += 1
+                return 429, {"ok": False, "error_code": 429,
+                             "description": f"Too Many Requests: retry after {self.retry_after}",
+                             "parameters": {"retry_after": self.retry_after}}
+
+        handler = getattr(self, f"api_{method}", None)
+        if handler is None:
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+        return 200, {"ok": True, "result": handler(payload)}
+
+    def api_getUpdates(self, payload):
+        offset = payload.get("offset", 0)
+        deadline = time.monotonic() + min(payload.get("timeout", 0), 30)
+        with self.lock:
+            # Confirmed updates are dropped, as Telegram does
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self.has_updates.wait(deadline - time.monotonic())
+            return self.updates[:payload.get("limit", 100)]
+
+    def api_getChatMember(self, payload):
+        tg = int(payload["user_id"])
+        with self.lock:
+            if tg not in self.membership:
+                self.membership[tg] = self.random.random() < self.members
+            elif self.churn and self.random.random() < self.churn:
+                self.membership[tg] = not self.membership[tg]
+            is_member = self.membership[tg]
+        return {"user": {"id": tg, "is_bot": False, "first_name": "bench"},
+                "status": "member" if is_member else "left"}
+
+    def api_sendMessage(self, payload):
+        with self.lock:
+            self.sent[int(payload["chat_id"])].append(time.monotonic())
+        return {"message_id": 1, "chat": {"id": payload["chat_id"]}, "date": int(time.time()),
+                "text": payload.get("text", "")}
+
+    def api_getFile(self, payload):
+        file_id = payload["file_id"]
+        return {"file_id": file_id, "file_size": len(self.files.get(file_id, b"")),
+                "file_path": f"documents/{file_id}"}
+
+    def api_answerCallbackQuery(self, payload):
+        return True
+
+    def api_deleteWebhook(self, payload):
+        with self.lock:
+            if payload.get("drop_pending_updates"):
+                self.updates = []
+        return True
+
+    def api_setWebhook(self, payload):
+        return True
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Run the fake Bot API standalone")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--churn", type=float, default=0.0)
+    args = parser.parse_args()
+
+    fake = FakeBotAPI(latency=args.latency, error_rate=args.error_rate,
+                      rate_429=args.rate_429, churn=args.churn)
+    print(f"🤖 Fake Bot API on {fake.start(port=args.port)} (set API_BASE to this)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# ============================================================
+# VISHAL X BOT - end-to-end benchmark suite
+# ============================================================
+"""Benchmark app.py against the in-process fake Bot API.
+
+    python bench/run.py                                   # 1k + 100k users, all scenarios
+    python bench/run.py --users 1000000 --scenarios http
+    python bench/run.py --latency 0.05 --rate-429 0.01 --churn 0.02
+    python bench/run.py --out bench/results/new.json --compare bench/results/base.json
+
+Each user count runs in its own process (app.py reads its config at import)
+with a fresh SQLite file, so results are independent of each other.
+
+Scenarios:
+    sweep    monitor sweep over a sample of users; checks/s and projected full sweep
+    updates  getUpdates -> handler -> sendMessage latency percentiles
+    http     requests/s and latency for /, /count and /stats
+"""
+import argparse, json, os, platform, sqlite3, subprocess, sys, tempfile, threading, time
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+
+# Metrics compared by --compare: (path, higher_is_better)
+REGRESSION_METRICS = [
+    ("sweep.checks_per_sec", True),
+    ("updates.e2e_ms.p50", False),
+    ("updates.e2e_ms.p95", False),
+    ("updates.e2e_ms.p99", False),
+    ("http./.rps", True),
+    ("http./count.rps", True),
+    ("http./stats.rps", True),
+    ("http./count.latency_ms.p95", False),
+    ("http./stats.latency_ms.p95", False),
+]
+
+def percentiles(samples):
+    """p50/p95/p99/max of latencies in milliseconds"""
+    if not samples:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    ordered = sorted(samples)
+    pick = lambda q: round(ordered[min(int(len(ordered) * q), len(ordered) - 1)], 2)
+    return {"p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99), "max": round(ordered[-1], 2)}
+
+# ================= CHILD: one user count ====================
+def seed(app, users, ids_per_user):
+    """Bulk-load users/user_states (triggers keep the counters in step)"""
+    started = time.monotonic()
+    chunk = 50000
+    with app.db_pool.writer() as db:
+        cur = db.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        for first in range(1, users + 1, chunk):
+            tgs = range(first, min(first + chunk, users + 1))
+            cur.executemany("INSERT INTO user_states (tg, status, strike_count, last_member_status) VALUES(?,?,?,?)",
+                            ((tg, 'active', 0, 'member') for tg in tgs))
+            cur.executemany("INSERT INTO users (tg, uid, status) VALUES(?,?,?)",
+                            ((tg, f"ID{tg:09d}{n}", 'active') for tg in tgs for n in range(ids_per_user)))
+        db.commit()
+    return round(time.monotonic() - started, 2)
+
+def bench_sweep(app, users, sample):
+    """Run one sweep over the first `sample` users through the real check path"""
+    tgs = list(range(1, min(users, sample) + 1))
+    stats = dict(app.run_sweep(tgs))
+    stats.pop("finished", None)
+    rate = stats["checks_per_sec"]
+    stats["projected_full_sweep_sec"] = round(users / rate, 1) if rate else None
+    stats["member_cache"] = app.member_cache.stats()
+    stats["http_pool"] = app.bot_api.stats()
+    return stats
+
+def bench_updates(app, fake, users, count, rate):
+    """Push updates through getUpdates at `rate`/s, time each until its reply is sent"""
+    app.leader.start()
+    deadline = time.monotonic() + 30
+    while fake.stats()["calls"].get("getUpdates", 0) == 0 and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    pushed = []
+    step = max(users // count, 1)
+    started = time.monotonic()
+    for i in range(count):
+        tg = 1 + (i * step) % users
+        if i % 5 == 4:
+            update = {"callback_query": {"id": str(i), "from": {"id": tg}, "data": "check_status"}}
+        else:
+            update = {"message": {"message_id": i, "from": {"id": tg}, "chat": {"id": tg}, "text": "/start"}}
+        pushed.append((tg, time.monotonic()))
+        fake.push_update(update)
+        # Open-loop arrival schedule
+        delay = started + (i + 1) / rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    latencies = []
+    deadline = time.monotonic() + 60
+    for tg, at in pushed:
+        while True:
+            sent = fake.first_send_after(tg, at)
+            if sent is not None or time.monotonic() > deadline:
+                break
+            time.sleep(0.01)
+        if sent is not None:
+            latencies.append((sent - at) * 1000)
+
+    return {
+        "updates": count,
+        "answered": len(latencies),
+        "offered_rate": rate,
+        "e2e_ms": percentiles(latencies),
+        "dispatcher": app.update_dispatch.stats(),
+        "outbound": app.outbound.stats()
+    }
+
+def bench_http(app, endpoints, clients, duration):
+    """Closed-loop load on each endpoint with `clients` keep-alive sessions"""
+    import logging, requests
+    from werkzeug.serving import make_server
+    
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    server = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+
+    results = {}
+    for endpoint in endpoints:
+        latencies = []
+        errors = [0]
+        lock = threading.Lock()
+        stop_at = time.monotonic() + duration
+
+        def client():
+            session = requests.Session()
+            local, failed = [], 0
+            while time.monotonic() < stop_at:
+                t0 = time.monotonic()
+                try:
+                    r = session.get(base + endpoint)
+                    r.content
+                    if r.status_code != 200:
+                        failed += 1
+                except requests.RequestException:
+                    failed += 1
+                local.append((time.monotonic() - t0) * 1000)
+            with lock:
+                latencies.extend(local)
+                errors[0] += failed
+
+        threads = [threading.Thread(target=client) for _ in range(clients)]
+        t0 = time.monotonic()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.monotonic() - t0
+        results[endpoint] = {
+            "requests": len(latencies),
+            "errors": errors[0],
+            "rps": round(len(latencies) / elapsed, 1),
+            "latency_ms": percentiles(latencies)
+        }
+
+    server.shutdown()
+    return results
+
+def run_child(args):
+    sys.path.insert(0, BENCH_DIR)
+    from fake_telegram import FakeBotAPI
+
+    fake = FakeBotAPI(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                      rate_429=args.rate_429, churn=args.churn, members=args.members)
+    os.environ["API_BASE"] = fake.start()
+
+    sys.path.insert(0, ROOT)
+    import app
+    if not args.verbose:
+        app.print = lambda *a, **k: None
+    # Only the poller should start on election; the sweep is driven directly
+    app.leader.on_elected[:] = [lambda takeover: threading.Thread(target=app.poller, daemon=True).start()]
+
+    result = {"users": args.size, "seed_seconds": seed(app, args.size, args.ids_per_user)}
+    scenarios = args.scenarios.split(",")
+    if "sweep" in scenarios:
+        result["sweep"] = bench_sweep(app, args.size, args.sweep_sample)
+    if "updates" in scenarios:
+        result["updates"] = bench_updates(app, fake, args.size, args.updates, args.update_rate)
+    if "http" in scenarios:
+        # Only the leader builds the / snapshot; followers answer 503 until it exists
+        app.leader.start()
+        app.leader.wait_until_leader()
+        result["http"] = bench_http(app, ["/", "/count", "/stats"], args.http_clients, args.http_duration)
+    result["fake_api"] = fake.stats()
+
+    with open(args.result, "w") as f:
+        json.dump(result, f)
+    fake.stop()
+    os._exit(0)  # daemon threads (poller, dispatchers) never return
+
+# ================= PARENT: orchestrate + compare ============
+def lookup(result, path):
+    """Value at a dotted metric path (endpoint keys like "/count" contain no dots)"""
+    node = result
+    for key in path.split("."):
+        if not isinstance(node, dict) or key not in node:
+            return None
+        node = node[key]
+    return node if isinstance(node, (int, float)) else None
+
+def compare(current, baseline, tolerance):
+    """Print metric deltas per user count; return the regressions"""
+    regressions = []
+    print(f"\n{'users':>9}  {'metric':<30}{'baseline':>12}{'current':>12}{'change':>11}")
+    for size, result in current["results"].items():
+        base = baseline.get("results", {}).get(size)
+        if not base:
+            continue
+        for path, higher_is_better in REGRESSION_METRICS:
+            old, new = lookup(base, path), lookup(result, path)
+            if old is None or new is None or old == 0:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            flag = "  ⚠️" if worse > tolerance else ""
+            if flag:
+                regressions.append((size, path, old, new))
+            print(f"{size:>9}  {path:<30}{old:>12g}{new:>12g}{change:>+10.1%}{flag}")
+    return regressions
+
+def run_parent(args):
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="vishal-bench-")
+    for size in [int(s) for s in args.users.split(",")]:
+        print(f"⏱️ {size} users: {args.scenarios}")
+        result_file = os.path.join(workdir, f"result-{size}.json")
+        env = dict(os.environ,
+                   DB_PATH=os.path.join(workdir, f"bench-{size}.db"),
+                   BOT_TOKEN="bench",
+                   CHANNEL="@bench",
+                   API_RATE_LIMIT=str(args.api_rate),
+                   API_BURST=str(int(args.api_rate)),
+                   SEND_RATE_LIMIT=str(args.api_rate),
+                   SEND_CHAT_INTERVAL="0",
+                   MONITOR_SHARDS="1")
+        cmd = [sys.executable, os.path.abspath(__file__), "--child", "--size", str(size), "--result", result_file]
+        cmd += sys.argv[1:]
+        started = time.monotonic()
+        proc = subprocess.run(cmd, env=env, cwd=workdir)
+        if proc.returncode != 0 or not os.path.exists(result_file):
+            print(f"❌ {size} users: benchmark process failed ({proc.returncode})")
+            continue
+        with open(result_file) as f:
+            results[str(size)] = json.load(f)
+        print(f"✅ {size} users done in {time.monotonic() - started:.1f}s")
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("child", "size", "result", "out", "compare")}
+        },
+        "results": results
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"📄 Results saved to {args.out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\n⚠️ {len(regressions)} metric(s) regressed more than {args.tolerance:.0%}")
+            return 1
+    return 0
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", default="1000,100000", help="comma separated user counts (e.g. 1000,100000,1000000)")
+    parser.add_argument("--scenarios", default="sweep,updates,http")
+    parser.add_argument("--ids-per-user", type=int, default=2)
+    parser.add_argument("--out", default=os.path.join(BENCH_DIR, "results", "latest.json"))
+    parser.add_argument("--compare", help="baseline results JSON to diff against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed regression before failing")
+    # fake Bot API behaviour
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per API call")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--churn", type=float, default=0.0)
+    parser.add_argument("--members", type=float, default=1.0, help="fraction of users in the channel")
+    parser.add_argument("--api-rate", type=float, default=10000, help="API_RATE_LIMIT / SEND_RATE_LIMIT for the run")
+    # scenario sizing
+    parser.add_argument("--sweep-sample", type=int, default=20000, help="users checked by the sweep scenario")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--update-rate", type=float, default=200, help="updates per second offered")
+    parser.add_argument("--http-clients", type=int, default=8)
+    parser.add_argument("--http-duration", type=float, default=5.0, help="seconds per endpoint")
+    parser.add_argument("--verbose", action="store_true", help="keep app.py logging")
+    # internal
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.child:
+        run_child(args)
+    else:
+        sys.exit(run_parent(args))
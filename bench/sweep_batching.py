@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# ============================================================
+# VISHAL X BOT - sweep write batching benchmark
+# ============================================================
+"""Compare the batched monitor sweep writes with the old per-user write path.
+
+    python bench/sweep_batching.py                        # 10k + 100k users
+    python bench/sweep_batching.py --users 10000 --rounds 3 --members 0.9
+    python bench/sweep_batching.py --latency 0.02 --out bench/results/sweep.json
+
+Every round checks all users through check_member() on the sweep worker pool
+against the in-process fake Bot API (same membership per user on both paths),
+then applies the results to SQLite and times that write phase:
+
+    batched   apply_member_results() per SWEEP_BATCH_SIZE chunk, as run_sweep() does
+    per-user  process_member_result() per user - one transaction each, as
+              run_sweep() did before the batching change
+
+The check phase is reported separately; against the fake API it is bound by
+loopback HTTP, not by SQLite. Each (user count, path) runs in its own process
+with a fresh SQLite file, and the final user_states rows - strikes, status,
+notices and the check schedule (stable_checks, next_check set) - must match
+between the paths.
+"""
+import argparse, hashlib, json, os, subprocess, sys, tempfile, time
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+PATHS = ("per-user", "batched")
+
+# ================= CHILD: one user count, one path ==========
+def check_all(app, users):
+    """Membership for every user through the real check path (worker pool + API)"""
+    return list(zip(users, app.sweep_executor.map(app.check_member, users)))
+
+def apply_per_user(app, results):
+    for tg, is_member in results:
+        app.process_member_result(tg, is_member)
+
+def apply_batched(app, results):
+    for first in range(0, len(results), app.SWEEP_BATCH_SIZE):
+        app.apply_member_results(results[first:first + app.SWEEP_BATCH_SIZE])
+
+def state_digest(app):
+    """Hash of the comparable user_states columns and status counts.
+    
+    Timestamps differ between runs: next_check is compared as set / unset, and
+    stable_checks (which fixes the check interval) stands in for its value.
+    """
+    digest = hashlib.sha256()
+    with app.db_pool.reader() as db:
+        for row in db.execute("""
+            SELECT tg, strike_count, status, last_member_status, last_notified_status, notifications_sent,
+                   stable_checks, next_check IS NULL
+            FROM user_states ORDER BY tg
+        """):
+            digest.update(repr(tuple(row)).encode())
+        statuses = dict(db.execute("SELECT status, COUNT(*) FROM user_states GROUP BY status").fetchall())
+    return digest.hexdigest()[:16], statuses
+
+def run_child(args):
+    sys.path.insert(0, BENCH_DIR)
+    from fake_telegram import FakeBotAPI
+    from run import seed
+
+    fake = FakeBotAPI(latency=args.latency, jitter=args.jitter)
+    # Same members on both paths, whatever order the workers ask in
+    fake.membership = {tg: (tg * 2654435761) % 1000 < args.members * 1000
+                       for tg in range(1, args.size + 1)}
+    os.environ["API_BASE"] = fake.start()
+
+    sys.path.insert(0, ROOT)
+    import app
+    if not args.verbose:
+        app.print = lambda *a, **k: None
+
+    result = {"users": args.size, "path": args.path, "seed_seconds": seed(app, args.size, 1), "rounds": []}
+    tgs = list(range(1, args.size + 1))
+    apply = apply_batched if args.path == "batched" else apply_per_user
+    for _ in range(args.rounds):
+        started = time.monotonic()
+        results = check_all(app, tgs)
+        checked = time.monotonic() - started
+        apply(app, results)
+        written = time.monotonic() - started - checked
+        result["rounds"].append({"check_seconds": round(checked, 3), "write_seconds": round(written, 3),
+                                 "writes_per_sec": round(len(results) / written, 1) if written > 0 else 0.0})
+    result["check_seconds"] = round(sum(r["check_seconds"] for r in result["rounds"]), 3)
+    result["write_seconds"] = round(sum(r["write_seconds"] for r in result["rounds"]), 3)
+    result["writes_per_sec"] = round(args.size * args.rounds / result["write_seconds"], 1)
+    result["state_digest"], result["statuses"] = state_digest(app)
+
+    with open(args.result, "w") as f:
+        json.dump(result, f)
+    fake.stop()
+    os._exit(0)  # sweep worker threads never return
+
+# ================= PARENT: orchestrate + report =============
+def run_parent(args):
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="vishal-sweep-")
+    for size in [int(s) for s in args.users.split(",")]:
+        for path in PATHS:
+            print(f"⏱️ {size} users: {path}")
+            result_file = os.path.join(workdir, f"result-{size}-{path}.json")
+            env = dict(os.environ,
+                       DB_PATH=os.path.join(workdir, f"bench-{size}-{path}.db"),
+                       BOT_TOKEN="bench",
+                       CHANNEL="@bench",
+                       API_RATE_LIMIT=str(args.api_rate),
+                       API_BURST=str(int(args.api_rate)),
+                       SEND_RATE_LIMIT=str(args.api_rate),
+                       SEND_CHAT_INTERVAL="0",
+                       # Fresh API answers every round so strikes build up
+                       MEMBER_CACHE_TTL="0",
+                       MEMBER_CACHE_NEGATIVE_TTL="0",
+                       MONITOR_SHARDS="1")
+            cmd = [sys.executable, os.path.abspath(__file__), "--child", "--size", str(size),
+                   "--path", path, "--result", result_file] + sys.argv[1:]
+            proc = subprocess.run(cmd, env=env, cwd=workdir)
+            if proc.returncode != 0 or not os.path.exists(result_file):
+                print(f"❌ {size} users / {path}: benchmark process failed ({proc.returncode})")
+                continue
+            with open(result_file) as f:
+                results.setdefault(str(size), {})[path] = json.load(f)
+
+    print(f"\n{'users':>9}  {'per-user write s':>17}{'batched write s':>16}{'speedup':>9}{'check s':>9}  state")
+    for size, paths in results.items():
+        if len(paths) != len(PATHS):
+            continue
+        slow, fast = paths["per-user"], paths["batched"]
+        same = "identical" if slow["state_digest"] == fast["state_digest"] else "⚠️ DIFFERENT"
+        speedup = slow["write_seconds"] / fast["write_seconds"] if fast["write_seconds"] else 0.0
+        paths["speedup"] = round(speedup, 1)
+        print(f"{size:>9}  {slow['write_seconds']:>17.2f}{fast['write_seconds']:>16.2f}{speedup:>8.1f}x"
+              f"{fast['check_seconds']:>9.2f}  {same}")
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("child", "size", "path", "result", "out")}
+        },
+        "results": results
+    }
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"📄 Results saved to {args.out}")
+    mismatched = [size for size, paths in results.items()
+                  if len({p.get("state_digest") for p in paths.values() if isinstance(p, dict)}) > 1]
+    return 1 if mismatched else 0
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", default="10000,100000", help="comma separated user counts")
+    parser.add_argument("--rounds", type=int, default=1, help="sweeps over every user (strikes build up)")
+    parser.add_argument("--members", type=float, default=0.9, help="fraction of users in the channel")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per API call")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--api-rate", type=float, default=100000, help="API_RATE_LIMIT / SEND_RATE_LIMIT for the run")
+    parser.add_argument("--out", help="write the results JSON here")
+    parser.add_argument("--verbose", action="store_true", help="keep app.py logging")
+    # internal
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--path", choices=PATHS, help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    sys.exit(run_child(args) if args.child else run_parent(args))
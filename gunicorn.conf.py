@@ -0,0 +1,13 @@
+# gunicorn -c gunicorn.conf.py app:app
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 8080)}"
+workers = int(os.getenv("WEB_CONCURRENCY", 4))
+threads = int(os.getenv("GUNICORN_THREADS", 4))
+timeout = 60
+
+def post_worker_init(worker):
+    # Every worker joins leader election; only the lease holder runs
+    # monitor, expiry and update ingestion, the rest serve HTTP reads.
+    import app
+    app.start_background()
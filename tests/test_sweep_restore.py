@@ -0,0 +1,54 @@
+"""A suspended user who rejoins is restored by the monitor sweep, IDs included.
+
+    python -m pytest tests
+"""
+import os, sys, tempfile, unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+sys.path.insert(0, ROOT)
+
+from fake_telegram import FakeBotAPI
+
+# app.py reads its config at import: point it at a scratch database and the fake API
+fake = FakeBotAPI()
+os.environ.update(API_BASE=fake.start(), BOT_TOKEN="test", CHANNEL="@test", SEND_CHAT_INTERVAL="0",
+                  DB_PATH=os.path.join(tempfile.mkdtemp(prefix="vishal-test-"), "data.db"),
+                  MEMBER_CACHE_TTL="0", MEMBER_CACHE_NEGATIVE_TTL="0")
+import app
+
+class SweepRestoreTest(unittest.TestCase):
+    def suspended_user(self, tg):
+        app.add_id(tg, f"{tg}-A")
+        app.add_id(tg, f"{tg}-B")
+        app.suspend_user(tg)
+        self.assertIn(tg, app.expiry.due_at)
+        self.assertEqual(app.count_user_ids(tg), 0)
+        fake.membership[tg] = True
+
+    def assert_restored(self, tg):
+        with app.db_pool.reader() as db:
+            state = db.execute("""
+                SELECT status, suspended_until, strike_count, next_check, stable_checks FROM user_states WHERE tg=?
+            """, (tg,)).fetchone()
+            ids = [row['status'] for row in db.execute("SELECT status FROM users WHERE tg=?", (tg,))]
+        self.assertEqual((state['status'], state['suspended_until'], state['strike_count']), ('active', None, 0))
+        self.assertEqual(ids, ['active', 'active'])
+        self.assertEqual(app.count_user_ids(tg), 2)
+        self.assertNotIn(tg, app.expiry.due_at)
+        # Back on the short check interval
+        self.assertIsNotNone(state['next_check'])
+        self.assertEqual(state['stable_checks'], 0)
+
+    def test_batched_sweep_restores_rejoined_user(self):
+        self.suspended_user(1001)
+        app.run_sweep([1001])
+        self.assert_restored(1001)
+
+    def test_per_user_path_restores_rejoined_user(self):
+        self.suspended_user(1002)
+        app.process_member_result(1002, app.check_member(1002))
+        self.assert_restored(1002)
+
+if __name__ == "__main__":
+    unittest.main()